@@ -0,0 +1,315 @@
+# --- Нагрузочный тест бота без сети ---
+# Поднимает локальные заглушки OpenDota и Telegram Bot API, прогоняет через настоящий
+# Dispatcher из main.py синтетические команды /profile, /top и /hero и считает
+# пропускную способность, перцентили задержки, число запросов к API и память.
+#
+# Пример: python bench.py --requests 2000 --concurrency 50 --latency 0.2 --output bench.json
+# Сравнение с прошлым прогоном: python bench.py --compare bench.json
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Dota 2 Stats Bot на локальных заглушках API")
+    parser.add_argument("--requests", type=int, default=1000, help="сколько команд отправить")
+    parser.add_argument("--concurrency", type=int, default=20, help="сколько команд обрабатывается одновременно")
+    parser.add_argument("--players", type=int, default=100, help="сколько разных ID игроков в запросах")
+    parser.add_argument("--chats", type=int, default=500, help="сколько разных чатов шлют команды")
+    parser.add_argument("--mix", default="profile=4,top=3,hero=3", help="доли команд, например profile=4,top=3,hero=3")
+    parser.add_argument("--latency", type=float, default=0.05, help="средняя задержка ответа OpenDota, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов OpenDota с кодом 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов OpenDota с кодом 429")
+    parser.add_argument("--heroes", type=int, default=130, help="сколько героев в ответе /heroes")
+    parser.add_argument("--hero-padding", type=int, default=2000, help="лишних байт на героя в /heroes (большой ответ)")
+    parser.add_argument("--matches", type=int, default=1000, help="сколько матчей у каждого игрока")
+    parser.add_argument("--opendota-rate", type=int, default=1200, help="квота OpenDota в минуту для бота")
+    parser.add_argument("--telegram-rate", type=float, default=1000, help="общий лимит отправки в Telegram, сообщений/сек")
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик памяти Python (замедляет прогон)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать результаты в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    return parser.parse_args()
+
+# --- Заглушка OpenDota ---
+
+class FakeOpenDota:
+    """
+    Отвечает на запросы бота к OpenDota детерминированными данными по ID игрока,
+    с настраиваемой задержкой и долей ошибок 500 и 429.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.calls = Counter()
+        self.statuses = Counter()
+        self.heroes = []
+
+    def set_heroes(self, hero_names):
+        padding = "x" * self.args.hero_padding
+        self.heroes = [
+            {"id": hero_id, "name": f"npc_dota_hero_{short}", "localized_name": name, "lore": padding}
+            for hero_id, (short, name) in enumerate(hero_names, start=1)
+        ]
+
+    def _player_matches(self, player_id: int):
+        rng = random.Random(player_id)
+        now = int(time.time())
+        hero_ids = [rng.randint(1, len(self.heroes)) for _ in range(8)] # Игроки обычно играют на нескольких героях
+        return [
+            {
+                "match_id": 7_000_000_000 - i,
+                "hero_id": rng.choice(hero_ids),
+                "start_time": now - i * 3600 * 6,
+                "player_slot": rng.choice((0, 128)),
+                "radiant_win": rng.random() < 0.5,
+            }
+            for i in range(self.args.matches)
+        ]
+
+    async def handle(self, request: web.Request):
+        parts = request.path.strip("/").split("/")[1:] # без префикса /api
+        endpoint = "/" + "/".join("{id}" if part.isdigit() else part for part in parts)
+        self.calls[endpoint] += 1
+        await asyncio.sleep(self.random.uniform(0, 2 * self.args.latency))
+        roll = self.random.random()
+        if roll < self.args.rate_limit_rate:
+            self.statuses[429] += 1
+            return web.json_response({"error": "rate limit"}, status=429, headers={"Retry-After": "1"})
+        if roll < self.args.rate_limit_rate + self.args.error_rate:
+            self.statuses[500] += 1
+            return web.json_response({"error": "internal"}, status=500)
+        self.statuses[200] += 1
+        if endpoint == "/heroes":
+            return web.json_response(self.heroes)
+        if endpoint == "/heroes/{id}":
+            return web.json_response(self.heroes[(int(parts[1]) - 1) % len(self.heroes)])
+        player_id = int(parts[1])
+        if endpoint == "/players/{id}":
+            rng = random.Random(player_id)
+            return web.json_response({
+                "profile": {"personaname": f"Player {player_id}", "steamid": str(76561197960265728 + player_id),
+                            "rank_tier": rng.randint(1, 8) * 10 + rng.randint(1, 5)},
+                "mmr_estimate": {"solo_estimate": rng.randint(1000, 9000)},
+            })
+        matches = self._player_matches(player_id)
+        if endpoint == "/players/{id}/wl":
+            wins = sum(1 for m in matches if (m["player_slot"] < 128) == m["radiant_win"])
+            return web.json_response({"win": wins, "lose": len(matches) - wins})
+        if endpoint == "/players/{id}/heroes":
+            stats = defaultdict(lambda: {"games": 0, "win": 0})
+            for m in matches:
+                stats[m["hero_id"]]["games"] += 1
+                stats[m["hero_id"]]["win"] += (m["player_slot"] < 128) == m["radiant_win"]
+            return web.json_response([{"hero_id": hero_id, **s} for hero_id, s in stats.items()])
+        if endpoint == "/players/{id}/matches":
+            if "date" in request.query: # Повторная синхронизация просит только последние дни
+                since = time.time() - int(request.query["date"]) * 86400
+                matches = [m for m in matches if m["start_time"] >= since]
+            return web.json_response(matches)
+        return web.json_response({"error": "not found"}, status=404)
+
+# --- Заглушка Telegram Bot API ---
+
+class FakeTelegram:
+    """
+    Принимает вызовы Bot API и отвечает успешно, как настоящий сервер.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        chat_id = int(data.get("chat_id", 0))
+        message = {
+            "message_id": int(data.get("message_id", 0)) or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", ""),
+        }
+        return web.json_response({"ok": True, "result": message})
+
+async def start_server(routes, port: int = 0):
+    app = web.Application()
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+# --- Нагрузка ---
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    command_length = len(text.split()[0])
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": command_length}],
+        },
+    }
+
+def make_commands(args, hero_names):
+    rng = random.Random(args.seed)
+    mix = {}
+    for item in args.mix.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    commands = []
+    for _ in range(args.requests):
+        kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+        player_id = 100000 + rng.randint(1, args.players)
+        if kind == "profile":
+            text = f"/profile {player_id}"
+        elif kind == "top":
+            text = f"/top {player_id}"
+        else:
+            text = f"/hero {player_id} {rng.choice(hero_names[:20])[1]}"
+        commands.append((kind, rng.randint(1, args.chats), text))
+    return commands
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {"p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99), "max_ms": round(values[-1] * 1000, 2)}
+
+async def run(args):
+    fake_opendota = FakeOpenDota(args)
+    fake_telegram = FakeTelegram()
+    opendota_runner, opendota_url = await start_server([("GET", "/api/{tail:.*}", fake_opendota.handle)])
+    telegram_runner, telegram_url = await start_server([("POST", "/bot{token}/{method}", fake_telegram.handle)])
+
+    workdir = tempfile.mkdtemp(prefix="dota-bot-bench-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:BENCHMARK",
+        "OPEN_DOTA_API_KEY": "bench",
+        "OPEN_DOTA_BASE_URL": f"{opendota_url}/api",
+        "TELEGRAM_API_SERVER": telegram_url,
+        "OPEN_DOTA_RATE_PER_MINUTE": str(args.opendota_rate),
+        "TELEGRAM_GLOBAL_RATE": str(args.telegram_rate),
+        "HEROES_FILE": os.path.join(workdir, "heroes.json"),
+        "MATCHES_DB_PATH": os.path.join(workdir, "matches.sqlite3"),
+        "FSM_DB_PATH": os.path.join(workdir, "fsm.sqlite3"),
+    })
+    # Бот импортируется только сейчас: main.py читает настройки из окружения при импорте
+    import main
+    from aiogram import Bot, Dispatcher, types
+
+    # Героев берем из справочника алиасов бота, чтобы команды /hero находили их по имени
+    hero_names = [(short, short.replace("_", " ").title()) for short in main.HERO_ALIASES]
+    hero_names += [(f"hero{i}", f"Hero {i}") for i in range(len(hero_names) + 1, args.heroes + 1)]
+    hero_names = hero_names[:args.heroes]
+    fake_opendota.set_heroes(hero_names)
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.on_startup(main.dp)
+    fake_opendota.calls.clear() # Загрузку справочника героев при старте не считаем
+    fake_opendota.statuses.clear()
+
+    commands = make_commands(args, hero_names)
+    latencies = defaultdict(list)
+    failures = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    async def one(update_id, kind, chat_id, text):
+        async with semaphore:
+            update = types.Update(**make_update(update_id, chat_id, text))
+            started = time.perf_counter()
+            try:
+                await main.dp.process_update(update)
+            except Exception:
+                failures[kind] += 1
+            latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i, kind, chat_id, text) for i, (kind, chat_id, text) in enumerate(commands, start=1)))
+    elapsed = time.perf_counter() - started
+
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    await main.on_shutdown(main.dp)
+    await (await main.bot.get_session()).close()
+    await opendota_runner.cleanup()
+    await telegram_runner.cleanup()
+    shutil.rmtree(workdir, ignore_errors=True) # Базы и справочник героев прогона больше не нужны
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_cmd_s": round(len(commands) / elapsed, 2),
+        "latency": {"all": percentiles(all_latencies), **{kind: percentiles(v) for kind, v in sorted(latencies.items())}},
+        "failures": dict(failures),
+        "opendota_calls": dict(fake_opendota.calls),
+        "opendota_calls_total": sum(fake_opendota.calls.values()),
+        "opendota_statuses": {str(status): count for status, count in fake_opendota.statuses.items()},
+        "telegram_calls": dict(fake_telegram.calls),
+        "telegram_calls_per_command": round(sum(fake_telegram.calls.values()) / len(commands), 3),
+        "cache": main.response_cache.snapshot(),
+        "memory": {
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "traced_peak_kb": traced_peak // 1024 if traced_peak is not None else None,
+        },
+    }
+
+def compare(current: dict, baseline: dict):
+    """
+    Печатает изменения ключевых метрик относительно прошлого прогона.
+    """
+    rows = [
+        ("throughput_cmd_s", current["throughput_cmd_s"], baseline.get("throughput_cmd_s")),
+        ("p50_ms", current["latency"]["all"].get("p50_ms"), baseline.get("latency", {}).get("all", {}).get("p50_ms")),
+        ("p99_ms", current["latency"]["all"].get("p99_ms"), baseline.get("latency", {}).get("all", {}).get("p99_ms")),
+        ("opendota_calls_total", current["opendota_calls_total"], baseline.get("opendota_calls_total")),
+        ("telegram_calls_per_command", current["telegram_calls_per_command"], baseline.get("telegram_calls_per_command")),
+        ("max_rss_kb", current["memory"]["max_rss_kb"], baseline.get("memory", {}).get("max_rss_kb")),
+    ]
+    for name, now, before in rows:
+        if before:
+            print(f"{name:28} {before:>12} -> {now:>12} ({(now - before) / before * 100:+.1f}%)")
+        else:
+            print(f"{name:28} {'-':>12} -> {now:>12}")
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,39 @@
 # --- Импорты библиотек ---
+import asyncio
+import bisect
+import contextvars
+import copy
+import difflib
+import heapq
+import html
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
 import aiohttp # Для асинхронных HTTP-запросов к API
+from aiohttp import web # Для режима webhook
 from dotenv import load_dotenv # Для загрузки переменных окружения из .env
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage # Для хранения состояний FSM в памяти
+from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage # Базовый класс для своего хранилища состояний FSM
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import (
+    InvalidQueryID, MessageCantBeEdited, MessageNotModified, MessageToEditNotFound, RetryAfter,
+)
 
 # --- Настройка логирования ---
 # Это поможет видеть, что происходит с ботом в консоли
@@ -29,94 +55,1679 @@ if not API_TOKEN:
 if not OPEN_DOTA_API_KEY:
     raise ValueError("OPEN_DOTA_API_KEY не найден в .env файле!")
 
+# Адрес Bot API: по умолчанию официальный, можно указать свой сервер (например, для нагрузочных тестов)
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER', '')
+
+# Настройки HTTP-клиента OpenDota (все необязательные, есть значения по умолчанию)
+OPEN_DOTA_BASE_URL = os.getenv('OPEN_DOTA_BASE_URL', 'https://api.opendota.com/api')
+OPEN_DOTA_POOL_SIZE = int(os.getenv('OPEN_DOTA_POOL_SIZE', '20')) # Размер пула соединений
+OPEN_DOTA_CONNECT_TIMEOUT = float(os.getenv('OPEN_DOTA_CONNECT_TIMEOUT', '5')) # Таймаут подключения, сек
+OPEN_DOTA_READ_TIMEOUT = float(os.getenv('OPEN_DOTA_READ_TIMEOUT', '15')) # Таймаут чтения ответа, сек
+
+# Лимиты OpenDota для нашего ключа: подставьте квоты своего тарифа
+OPEN_DOTA_RATE_PER_MINUTE = int(os.getenv('OPEN_DOTA_RATE_PER_MINUTE', '1200')) # Запросов в минуту
+OPEN_DOTA_RATE_PER_DAY = int(os.getenv('OPEN_DOTA_RATE_PER_DAY', '0')) # Запросов в сутки (0 - без ограничения)
+OPEN_DOTA_BURST = int(os.getenv('OPEN_DOTA_BURST', '20')) # Сколько запросов можно отправить разом
+OPEN_DOTA_MAX_QUEUE = int(os.getenv('OPEN_DOTA_MAX_QUEUE', '200')) # Максимальная очередь ожидающих запросов
+OPEN_DOTA_MAX_RETRIES = int(os.getenv('OPEN_DOTA_MAX_RETRIES', '3')) # Повторы при 429 и 5xx
+
+# Настройки кэша ответов OpenDota
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '5000')) # Сколько ответов держим в памяти (LRU)
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024))) # ... и сколько они весят в JSON, байт
+CACHE_NEGATIVE_TTL = int(os.getenv('CACHE_NEGATIVE_TTL', '60')) # Сколько помним, что игрок не найден, сек
+# Сколько секунд после истечения TTL можно отдавать устаревший ответ, пока в фоне грузится свежий
+CACHE_STALE_TTL = int(os.getenv('CACHE_STALE_TTL', '600'))
+# Время жизни кэша для каждого типа запроса, сек: профиль меняется редко, W/L - часто.
+# Герои игрока считаются по локальной истории матчей, а справочник героев - в HeroCatalog
+CACHE_TTL = {
+    "player": int(os.getenv('CACHE_TTL_PLAYER', '600')),
+    "wl": int(os.getenv('CACHE_TTL_WL', '120')),
+}
+
+# Сколько секунд команда ждет данные от OpenDota, прежде чем ответить тем, что успело прийти
+COMMAND_DEADLINE = float(os.getenv('COMMAND_DEADLINE', '8'))
+
+# Справочник героев: хранится в локальном файле, чтобы при запуске не ходить в сеть
+HEROES_FILE = os.getenv('HEROES_FILE', 'heroes.json')
+HEROES_REFRESH_INTERVAL = int(os.getenv('HEROES_REFRESH_INTERVAL', '86400')) # Как часто обновлять список, сек
+
+# Локальная история матчей: статистику по героям считаем сами, а не скачиваем заново
+MATCHES_DB_PATH = os.getenv('MATCHES_DB_PATH', 'matches.sqlite3')
+MATCHES_SYNC_INTERVAL = int(os.getenv('MATCHES_SYNC_INTERVAL', '300')) # Не чаще, чем раз в столько секунд на игрока
+MATCHES_MEMORY_PLAYERS = int(os.getenv('MATCHES_MEMORY_PLAYERS', '500')) # Для скольких игроков держим матчи в памяти
+
+# Лимиты Telegram на отправку сообщений: общий на бота и отдельный на каждый чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')) # Сообщений в секунду на весь бот
+TELEGRAM_PRIVATE_RATE = float(os.getenv('TELEGRAM_PRIVATE_RATE', '1')) # Сообщений в секунду в личном чате
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', str(20 / 60))) # Сообщений в секунду в группе
+# Если ответ готов быстрее этого времени (сек), сообщение "Загружаю..." вообще не отправляется
+PLACEHOLDER_DELAY = float(os.getenv('PLACEHOLDER_DELAY', '0.7'))
+
+# Метрики в формате Prometheus: порт HTTP-сервера с /metrics (0 - не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01')) # Доля команд, для которых пишем подробную трассировку
+SLOW_COMMAND_THRESHOLD = float(os.getenv('SLOW_COMMAND_THRESHOLD', '3')) # С какой длительности (сек) команда считается медленной
+
+# Фоновый прогрев кэша для популярных и отслеживаемых игроков
+PREFETCH_TICK = float(os.getenv('PREFETCH_TICK', '15')) # Как часто планировщик просыпается, сек
+PREFETCH_HALF_LIFE = float(os.getenv('PREFETCH_HALF_LIFE', '600')) # За сколько секунд популярность игрока падает вдвое
+PREFETCH_HOT_SCORE = float(os.getenv('PREFETCH_HOT_SCORE', '3')) # С какой популярности игрока прогреваем
+PREFETCH_COLD_SCORE = float(os.getenv('PREFETCH_COLD_SCORE', '0.1')) # Ниже этой популярности игрок забывается
+PREFETCH_MIN_INTERVAL = float(os.getenv('PREFETCH_MIN_INTERVAL', '120')) # Самое частое обновление игрока, сек
+PREFETCH_MAX_INTERVAL = float(os.getenv('PREFETCH_MAX_INTERVAL', '1800')) # Самое редкое обновление игрока, сек
+PREFETCH_WATCH_INTERVAL = float(os.getenv('PREFETCH_WATCH_INTERVAL', '600')) # Обновление игроков из /watch, сек
+PREFETCH_QUOTA_SHARE = float(os.getenv('PREFETCH_QUOTA_SHARE', '0.2')) # Какую долю квоты OpenDota можно тратить на прогрев
+PREFETCH_MAX_PLAYERS = int(os.getenv('PREFETCH_MAX_PLAYERS', '1000')) # Сколько игроков отслеживаем
+WATCHLIST_LIMIT = int(os.getenv('WATCHLIST_LIMIT', '10')) # Сколько игроков можно добавить в /watch из одного чата
+
+# Сравнение нескольких игроков (/compare, /party)
+COMPARE_MAX_PLAYERS = int(os.getenv('COMPARE_MAX_PLAYERS', '10')) # Сколько игроков можно сравнить за раз
+COMPARE_CONCURRENCY = int(os.getenv('COMPARE_CONCURRENCY', '4')) # Сколько игроков загружаем одновременно
+COMPARE_STREAM_FROM = int(os.getenv('COMPARE_STREAM_FROM', '4')) # С какого размера группы показываем таблицу по мере загрузки
+COMPARE_EDIT_INTERVAL = float(os.getenv('COMPARE_EDIT_INTERVAL', '2')) # Как часто обновлять таблицу при загрузке, сек
+
+# Inline-режим (@бот 70388657)
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.4')) # Сколько ждать, пока пользователь допечатает запрос, сек
+INLINE_DEADLINE = float(os.getenv('INLINE_DEADLINE', '6')) # Сколько ждать OpenDota для inline-ответа, сек
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300')) # Сколько Telegram кэширует удачный inline-ответ, сек
+INLINE_ERROR_CACHE_TIME = int(os.getenv('INLINE_ERROR_CACHE_TIME', '10')) # ... и ответ с ошибкой, сек
+INLINE_HINT_CACHE_TIME = int(os.getenv('INLINE_HINT_CACHE_TIME', '3600')) # ... и подсказки из локальных данных, сек
+
+# Режим работы: polling (по умолчанию, один процесс) или webhook (роутер + несколько процессов-обработчиков)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '') # Публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '') # Секрет, который Telegram присылает в заголовке
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', str(os.cpu_count() or 1))) # Сколько процессов-обработчиков
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')) # Очередь обновлений на один процесс
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')) # Сколько ждем обработчики при остановке, сек
+
+# Хранилище состояний FSM на диске: переживает перезапуск бота
+FSM_DB_PATH = os.getenv('FSM_DB_PATH', 'fsm.sqlite3')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '3600')) # Через сколько секунд брошенный диалог забывается
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000')) # Сколько чатов держим в памяти
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1')) # Как часто сбрасываем изменения на диск, сек
+
+# ID администраторов через запятую: им доступны служебные команды вроде /cachestats
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}
+
+# --- Хранилище состояний FSM ---
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в SQLite вместо MemoryStorage.
+    На каждую пару (чат, пользователь) - одна строка: состояние и данные в компактном JSON.
+    Недавние записи лежат в LRU-кэше в памяти, изменения пишутся на диск пачками
+    раз в flush_interval секунд, а записи старше state_ttl считаются брошенными и удаляются.
+    """
+
+    def __init__(self, path: str, state_ttl: int, cache_size: int, flush_interval: float):
+        self.path = path
+        self.state_ttl = state_ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._cache = OrderedDict() # (chat, user) -> [state, data, bucket, updated_at]
+        self._dirty = {} # Записи, измененные после последнего сброса на диск
+        self._flusher = None
+        self._purged_at = 0.0
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " chat INTEGER NOT NULL, user INTEGER NOT NULL, state TEXT, data TEXT, bucket TEXT,"
+                " updated_at REAL NOT NULL, PRIMARY KEY (chat, user)) WITHOUT ROWID"
+            )
+            self._db.commit()
+        return self._db
+
+    def _load(self, key: tuple) -> list:
+        with self._db_lock:
+            row = self._connect().execute(
+                "SELECT state, data, bucket, updated_at FROM fsm WHERE chat = ? AND user = ?", key
+            ).fetchone()
+        if row is None:
+            return [None, {}, {}, 0.0]
+        state, data, bucket, updated_at = row
+        return [state, json.loads(data) if data else {}, json.loads(bucket) if bucket else {}, updated_at]
+
+    def _write(self, batch: dict):
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            for (chat, user), (state, data, bucket, updated_at) in batch.items():
+                if state is None and not data and not bucket: # Пустые записи не храним
+                    db.execute("DELETE FROM fsm WHERE chat = ? AND user = ?", (chat, user))
+                    continue
+                db.execute(
+                    "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (chat, user, state,
+                     json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None,
+                     json.dumps(bucket, ensure_ascii=False, separators=(",", ":")) if bucket else None,
+                     updated_at),
+                )
+            if now - self._purged_at > 60: # Раз в минуту удаляем брошенные диалоги
+                db.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.state_ttl,))
+                self._purged_at = now
+            db.commit()
+
+    async def _flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except BaseException: # Запись не удалась - вернем пачку, чтобы повторить в следующий раз
+            for key, record in batch.items():
+                self._dirty.setdefault(key, record) # Более новые изменения уже лежат в _dirty
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except sqlite3.Error as e:
+                logging.error(f"Не удалось сохранить состояния FSM: {e}")
+
+    async def _record(self, chat, user) -> list:
+        key = tuple(int(x) for x in self.check_address(chat=chat, user=user))
+        record = self._cache.get(key) or self._dirty.get(key)
+        if record is None:
+            record = await asyncio.to_thread(self._load, key)
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size: # Измененные записи не теряются: они еще лежат в _dirty
+            self._cache.popitem(last=False)
+        if record[3] and time.time() - record[3] > self.state_ttl and (record[0] is not None or record[1]):
+            record[:3] = [None, {}, {}] # Диалог брошен - начинаем с чистого листа
+            self._touch(key, record)
+        return record
+
+    def _touch(self, key: tuple, record: list):
+        record[3] = time.time()
+        self._dirty[key] = record
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _update(self, chat, user, index: int, value):
+        key = tuple(int(x) for x in self.check_address(chat=chat, user=user))
+        record = await self._record(chat, user)
+        record[index] = value
+        self._touch(key, record)
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self._flush()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state = (await self._record(chat, user))[0]
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return copy.deepcopy((await self._record(chat, user))[1])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self._update(chat, user, 0, self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._update(chat, user, 1, copy.deepcopy(data or {}))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self._update(chat, user, 1, current)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return copy.deepcopy((await self._record(chat, user))[2])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self._update(chat, user, 2, copy.deepcopy(bucket or {}))
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        current = await self.get_bucket(chat=chat, user=user)
+        current.update(bucket or {}, **kwargs)
+        await self._update(chat, user, 2, current)
+
 # --- Инициализация бота и диспетчера ---
 # Bot - это сам экземпляр бота, через который отправляются запросы к Telegram API
-bot = Bot(token=API_TOKEN, parse_mode=types.ParseMode.HTML) # parse_mode=HTML для жирного текста и т.д.
-# MemoryStorage - хранилище состояний FSM (для учебного проекта достаточно)
-storage = MemoryStorage()
+bot = Bot(
+    token=API_TOKEN,
+    parse_mode=types.ParseMode.HTML, # parse_mode=HTML для жирного текста и т.д.
+    server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION,
+)
+# Хранилище состояний FSM на диске: незавершенные диалоги переживают перезапуск
+storage = SQLiteStorage(FSM_DB_PATH, FSM_STATE_TTL, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL)
 # Dispatcher - обрабатывает входящие обновления от Telegram
 dp = Dispatcher(bot, storage=storage)
 
 # --- Определение состояний для FSM ---
 # Используется для пошагового ввода данных от пользователя
 class Form(StatesGroup):
-    player_id = State() # Состояние ожидания ID игрока
+    player_id = State() # Состояние ожидания ID игрока (какой команде он нужен - в данных состояния, ключ "command")
+
+# --- Метрики и трассировка ---
+# Счетчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus.
+# Обновление метрики - это пара операций со словарем, так что их можно держать включенными всегда.
+
+# Границы корзин гистограмм задержки, сек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metric:
+    """
+    Одна метрика (counter, gauge или histogram) со значениями по наборам меток.
+    """
+
+    def __init__(self, name: str, kind: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {} # кортеж значений меток -> число (или [счетчики корзин..., сумма, количество])
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[tuple(labels.get(label, "") for label in self.labels)] = value
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value) # Корзина "le" - первая граница не меньше значения
+        if index < len(self.buckets): # Значения больше последней границы попадают только в +Inf
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def _label_text(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._label_text(key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets, value):
+                cumulative += count
+                bucket_labels = self._label_text(key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            inf_labels = self._label_text(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {value[-1]}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {value[-2]}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {value[-1]}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Набор метрик процесса. Функции из on_collect вызываются перед выдачей /metrics,
+    чтобы обновить метрики, которые проще снять снимком (очереди, кэш).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self.on_collect = []
+
+    def _add(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Metric:
+        return self._add(Metric(name, "counter", help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple = ()) -> Metric:
+        return self._add(Metric(name, "gauge", help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Metric:
+        return self._add(Metric(name, "histogram", help_text, labels, buckets))
+
+    def render(self) -> str:
+        for collect in self.on_collect:
+            collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_DURATION = metrics.histogram("bot_handler_duration_seconds", "Время работы обработчика", ("handler",))
+HANDLER_IN_FLIGHT = metrics.gauge("bot_handlers_in_flight", "Обработчики, которые выполняются сейчас", ("handler",))
+UPDATE_LAG = metrics.histogram("bot_update_lag_seconds", "Сколько прошло от отправки сообщения до начала обработки")
+OPENDOTA_REQUESTS = metrics.counter("opendota_requests_total", "Запросы к OpenDota", ("endpoint", "status"))
+OPENDOTA_DURATION = metrics.histogram("opendota_request_duration_seconds", "Время ответа OpenDota", ("endpoint",))
+OPENDOTA_WAIT = metrics.histogram("opendota_queue_wait_seconds", "Ожидание разрешения планировщика лимитов", ("endpoint",))
+OPENDOTA_IN_FLIGHT = metrics.gauge("opendota_requests_in_flight", "Запросы к OpenDota, ожидающие ответа")
+TELEGRAM_REQUESTS = metrics.counter("telegram_requests_total", "Вызовы Telegram Bot API", ("method", "status"))
+TELEGRAM_DURATION = metrics.histogram("telegram_request_duration_seconds", "Время ответа Telegram", ("method",))
+TELEGRAM_WAIT = metrics.histogram("telegram_send_wait_seconds", "Ожидание очереди отправки в Telegram", ("method",))
+LOOP_LAG = metrics.histogram("event_loop_lag_seconds", "Задержка цикла событий", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+def endpoint_template(path: str) -> str:
+    """
+    Путь запроса без конкретных ID, чтобы у метрик было мало значений меток: /players/1/wl -> /players/{id}/wl.
+    """
+    return "/".join("{id}" if part.isdigit() else part for part in path.split("/"))
+
+# Трассировка отдельных команд: для выбранной доли команд собираем все их вызовы API
+# и пишем в лог, если команда выполнялась дольше SLOW_COMMAND_THRESHOLD
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def trace_span(kind: str, name: str, started: float, **details):
+    """
+    Добавляет шаг в трассировку текущей команды (если она трассируется).
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append({"kind": kind, "name": name, "at_ms": round((started - trace[0]) * 1000, 1),
+                      "duration_ms": round((time.perf_counter() - started) * 1000, 1), **details})
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Замеряет время работы каждого обработчика, число одновременно работающих
+    обработчиков и задержку доставки обновлений.
+    """
+
+    def __init__(self, sample_rate: float, slow_threshold: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    async def _start(self, event, data: dict):
+        handler = current_handler.get(None)
+        name = getattr(handler, "__name__", "unknown")
+        data["_metrics"] = (name, time.perf_counter())
+        HANDLER_IN_FLIGHT.inc(handler=name)
+        date = getattr(event, "date", None)
+        if date is not None:
+            UPDATE_LAG.observe(max(0.0, time.time() - date.timestamp()))
+        if random.random() < self.sample_rate:
+            data["_trace_token"] = current_trace.set([time.perf_counter()]) # Первый элемент - время начала
+
+    async def _finish(self, event, data: dict):
+        if "_metrics" not in data: # Ни один обработчик не подошел
+            return
+        name, started = data.pop("_metrics")
+        duration = time.perf_counter() - started
+        HANDLER_DURATION.observe(duration, handler=name)
+        HANDLER_IN_FLIGHT.dec(handler=name)
+        token = data.pop("_trace_token", None)
+        if token is not None:
+            trace = current_trace.get()
+            current_trace.reset(token)
+            if duration >= self.slow_threshold:
+                logging.warning(f"Медленная команда {name}: {duration:.2f} с, шаги: {json.dumps(trace[1:], ensure_ascii=False)}")
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self._start(message, data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        await self._finish(message, data)
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict):
+        await self._start(query, data)
+
+    async def on_post_process_inline_query(self, query: types.InlineQuery, results, data: dict):
+        await self._finish(query, data)
+
+async def monitor_event_loop(interval: float = 0.5):
+    """
+    Фоновая задача: насколько позже запланированного просыпается цикл событий.
+    Большая задержка значит, что что-то блокирует цикл (тяжелые вычисления, синхронный ввод-вывод).
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+async def handle_metrics(request: web.Request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(port: int):
+    """
+    Запускает HTTP-сервер с /metrics. Возвращает runner для остановки.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logging.info(f"Метрики доступны на порту {port}: /metrics")
+    return runner
+
+dp.middleware.setup(MetricsMiddleware(TRACE_SAMPLE_RATE, SLOW_COMMAND_THRESHOLD))
 
 # --- Вспомогательные функции для работы с OpenDota API ---
 
+# Приоритеты запросов к OpenDota: чем меньше число, тем раньше запрос уйдет в API
+PRIORITY_INTERACTIVE = 0 # Команды, которые ждет пользователь
+PRIORITY_BACKGROUND = 10 # Фоновая работа (обновление справочников, прогрев кэша)
+
+class RateLimitQueueFull(Exception):
+    """
+    Очередь запросов к OpenDota переполнена - новый запрос лучше сразу отклонить.
+    """
+
+# Планировщик запросов к OpenDota. Без него всплеск команд /profile отправлял все
+# запросы разом, и пользователи получали "Ошибка OpenDota API: 429".
+class RateLimitScheduler:
+    """
+    Выдает разрешения на запросы к OpenDota в пределах квоты.
+    Квота в минуту - ведро токенов (token bucket), квота в сутки - простой счетчик.
+    Ожидающие запросы лежат в очереди с приоритетом: интерактивные команды идут раньше фоновых.
+    """
+
+    def __init__(self, per_minute: int, per_day: int = 0, burst: int = 20, max_queue: int = 200):
+        self.rate = per_minute / 60.0 # Токенов в секунду
+        self.capacity = max(1, min(burst, per_minute))
+        self.per_day = per_day
+        self.max_queue = max_queue
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0 # До этого момента запросы не отправляем (после 429 или исчерпания квоты)
+        self._day = datetime.now(timezone.utc).date()
+        self._day_used = 0
+        self._queue = [] # куча из (приоритет, порядковый номер, future)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    def start(self):
+        """
+        Запускает фоновую задачу, которая раздает разрешения из очереди.
+        """
+        if self._worker is None:
+            self._wakeup = asyncio.Event() # Событие должно принадлежать текущему циклу событий
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        Останавливает раздачу разрешений и отменяет всех ожидающих.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for _, _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Ждет разрешения на один запрос к OpenDota.
+        Если очередь слишком длинная, сразу выбрасывает RateLimitQueueFull.
+        Фоновым запросам доступна только половина очереди, чтобы они не вытесняли команды.
+        """
+        limit = self.max_queue if priority <= PRIORITY_INTERACTIVE else self.max_queue // 2
+        if len(self._queue) >= limit:
+            raise RateLimitQueueFull()
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (priority, self._seq, future))
+        self._wakeup.set()
+        await future
+
+    def pause(self, seconds: float):
+        """
+        Приостанавливает отправку запросов (например, после ответа 429).
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def on_response(self, headers):
+        """
+        Подстраивается под заголовки лимитов, которые вернул OpenDota.
+        """
+        remaining_minute = headers.get("X-Rate-Limit-Remaining-Minute")
+        if remaining_minute is not None and remaining_minute.lstrip("-").isdigit():
+            remaining = int(remaining_minute)
+            self._tokens = min(self._tokens, max(remaining, 0))
+            if remaining <= 0: # Минутная квота исчерпана - ждем начала следующей минуты
+                self.pause(60 - time.time() % 60)
+        remaining_day = headers.get("X-Rate-Limit-Remaining-Day")
+        if remaining_day is not None and remaining_day.lstrip("-").isdigit() and int(remaining_day) <= 0:
+            self.pause(self._seconds_until_next_day())
+
+    def _seconds_until_next_day(self) -> float:
+        now = datetime.now(timezone.utc)
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        return (tomorrow - now).total_seconds()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        today = datetime.now(timezone.utc).date()
+        if today != self._day: # Суточная квота обнуляется в полночь по UTC
+            self._day = today
+            self._day_used = 0
+
+    def _wait_time(self) -> float:
+        """
+        Сколько секунд нужно подождать до следующего разрешения (0 - можно сейчас).
+        """
+        self._refill()
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self.per_day and self._day_used >= self.per_day:
+            return self._seconds_until_next_day()
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        return 0
+
+    async def _run(self):
+        while True:
+            while self._queue and self._queue[0][2].done(): # Убираем отмененные ожидания
+                heapq.heappop(self._queue)
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._wait_time()
+            if delay > 0:
+                await asyncio.sleep(min(delay, 1.0)) # Спим короткими шагами: могла прийти пауза или отмена
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._tokens -= 1
+            self._day_used += 1
+            future.set_result(None)
+
+# Клиент для OpenDota API: одна долгоживущая сессия на всё время работы бота.
+# Раньше каждая функция открывала свой aiohttp.ClientSession, и на каждый запрос
+# уходили DNS-запрос и новое TCP+TLS-соединение.
+class OpenDotaClient:
+    """
+    Общий HTTP-клиент для OpenDota API с пулом соединений и keep-alive.
+    Создается при старте бота (start) и закрывается при остановке (close).
+    Все ошибки API переводятся в словарь {"error": ...} в одном месте (get_json).
+    Каждый запрос сначала получает разрешение у планировщика лимитов.
+    """
+
+    def __init__(self, base_url: str, api_key: str, scheduler: RateLimitScheduler,
+                 pool_size: int = 20, connect_timeout: float = 5.0, read_timeout: float = 15.0,
+                 dns_cache_ttl: int = 300, keepalive_timeout: float = 30.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    async def start(self):
+        """
+        Создает пул соединений. Вызывается один раз при запуске бота.
+        """
+        if self._session is not None:
+            return
+        self.scheduler.start()
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size, # Максимум одновременных соединений с OpenDota
+            limit_per_host=self.pool_size,
+            ttl_dns_cache=self.dns_cache_ttl, # Кэшируем DNS, чтобы не резолвить хост на каждый запрос
+            keepalive_timeout=self.keepalive_timeout, # Держим соединения открытыми между запросами
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        """
+        Закрывает сессию и все соединения пула. Вызывается при остановке бота.
+        """
+        await self.scheduler.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        """
+        Пауза перед повтором: Retry-After от сервера, иначе экспоненциальная с джиттером.
+        """
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def get_json(self, path: str, what: str, not_found: str = None,
+                       priority: int = PRIORITY_INTERACTIVE, params: list = None):
+        """
+        Выполняет GET-запрос к OpenDota и возвращает распарсенный JSON.
+        При ошибке возвращает {"error": текст, "status": код}, как и раньше делали хелперы.
+        what - что именно запрашиваем (для текста ошибки), not_found - текст для 404.
+        params - дополнительные параметры запроса списком пар (ключи могут повторяться).
+        Ответы 429 и 5xx повторяются с паузой до max_retries раз.
+        """
+        if self._session is None: # На случай вызова до старта бота (например, из консоли)
+            await self.start()
+        url = f"{self.base_url}{path}"
+        params = list(params or [])
+        if self.api_key:
+            params.append(("api_key", self.api_key))
+        endpoint = endpoint_template(path)
+        attempt = 0
+        while True:
+            waited_from = time.perf_counter()
+            try:
+                await self.scheduler.acquire(priority)
+            except RateLimitQueueFull:
+                OPENDOTA_REQUESTS.inc(endpoint=endpoint, status="queue_full")
+                return {"error": "Сейчас слишком много запросов к OpenDota. Попробуйте через минуту.", "status": None}
+            started = time.perf_counter()
+            OPENDOTA_WAIT.observe(started - waited_from, endpoint=endpoint)
+            OPENDOTA_IN_FLIGHT.inc()
+            status = "error"
+            try:
+                async with self._session.get(url, params=params) as response:
+                    status = str(response.status)
+                    self.scheduler.on_response(response.headers)
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status == 404 and not_found:
+                        return {"error": not_found, "status": 404}
+                    if (response.status == 429 or response.status >= 500) and attempt < self.max_retries:
+                        delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                        if response.status == 429: # Притормаживаем все запросы, а не только этот
+                            self.scheduler.pause(delay)
+                        logging.warning(f"OpenDota вернул {response.status} на {path}, повтор через {delay:.1f} с")
+                    elif response.status == 429:
+                        return {"error": "OpenDota ограничил частоту запросов. Попробуйте через минуту.", "status": 429}
+                    else:
+                        return {"error": f"Ошибка OpenDota API при получении {what}: {response.status}. Попробуйте позже.",
+                                "status": response.status}
+            except asyncio.TimeoutError: # Превышен таймаут подключения или чтения
+                status = "timeout"
+                return {"error": f"OpenDota API не ответил вовремя при получении {what}. Попробуйте позже.", "status": None}
+            except aiohttp.ClientError: # Ошибка сетевого подключения
+                return {"error": f"Не удалось подключиться к OpenDota API при получении {what}. Попробуйте позже.", "status": None}
+            except Exception as e: # Любая другая непредвиденная ошибка
+                logging.error(f"Непредвиденная ошибка при запросе {path} к OpenDota: {e}")
+                return {"error": "Произошла непредвиденная ошибка. Попробуйте позже.", "status": None}
+            finally:
+                OPENDOTA_IN_FLIGHT.dec()
+                OPENDOTA_REQUESTS.inc(endpoint=endpoint, status=status)
+                OPENDOTA_DURATION.observe(time.perf_counter() - started, endpoint=endpoint)
+                trace_span("opendota", endpoint, waited_from, status=status, attempt=attempt,
+                           queue_ms=round((started - waited_from) * 1000, 1))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+# Единственный экземпляр клиента на всё приложение
+opendota = OpenDotaClient(
+    OPEN_DOTA_BASE_URL,
+    OPEN_DOTA_API_KEY,
+    RateLimitScheduler(OPEN_DOTA_RATE_PER_MINUTE, OPEN_DOTA_RATE_PER_DAY,
+                       burst=OPEN_DOTA_BURST, max_queue=OPEN_DOTA_MAX_QUEUE),
+    pool_size=OPEN_DOTA_POOL_SIZE,
+    connect_timeout=OPEN_DOTA_CONNECT_TIMEOUT,
+    read_timeout=OPEN_DOTA_READ_TIMEOUT,
+    max_retries=OPEN_DOTA_MAX_RETRIES,
+)
+
+# Кэш ответов OpenDota. Когда ID популярного игрока разлетается по чату, десятки
+# одинаковых запросов приходят за секунды - отвечаем из памяти, а одновременные
+# промахи по одному ключу ждут один общий запрос к API (single-flight).
+class ResponseCache:
+    """
+    Асинхронный TTL-кэш с LRU-вытеснением и объединением одновременных запросов.
+    Успешные ответы хранятся ttl секунд, ответы 404 - negative_ttl секунд,
+    остальные ошибки не кэшируются. Еще stale_ttl секунд после истечения TTL
+    успешный ответ отдается сразу, а свежий загружается в фоне (stale-while-revalidate).
+    Размер ограничен и числом записей, и их общим весом: ответ /players/{id}/heroes
+    примерно в сто раз больше ответа /wl, поэтому одного счетчика записей мало.
+    """
+
+    def __init__(self, max_entries: int, negative_ttl: int, stale_ttl: int = 0, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes # 0 - без ограничения по весу
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict() # ключ -> (момент истечения, значение, вес), порядок = давность использования
+        self._bytes = 0 # Общий вес записей (длина ответов в JSON)
+        self._inflight = {} # ключ -> задача, которая сейчас загружает значение
+        self.stats = {"hits": 0, "negative_hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0,
+                      "refreshes": 0, "evictions": 0}
+
+    async def get_or_fetch(self, key, ttl: int, fetch, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Возвращает значение из кэша или загружает его через fetch(priority) (корутина-функция).
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value, _ = entry
+            now = time.monotonic()
+            failed = isinstance(value, dict) and "error" in value
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats["negative_hits" if failed else "hits"] += 1
+                return value
+            if not failed and expires_at + self.stale_ttl > now:
+                # Отдаем устаревший ответ сразу, а свежий грузим в фоне с низким приоритетом
+                self._entries.move_to_end(key)
+                self.stats["stale_hits"] += 1
+                self._start_fetch(key, ttl, fetch, PRIORITY_BACKGROUND)
+                return value
+            self._pop(key) # Запись устарела
+
+        if key in self._inflight: # Такой же запрос уже выполняется - ждем его результат
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+        return await asyncio.shield(self._start_fetch(key, ttl, fetch, priority))
+
+    async def refresh(self, key, ttl: int, fetch, priority: int = PRIORITY_BACKGROUND):
+        """
+        Загружает свежее значение, даже если в кэше есть действующее (для фонового прогрева).
+        """
+        self.stats["refreshes"] += 1
+        return await asyncio.shield(self._start_fetch(key, ttl, fetch, priority))
+
+    def _start_fetch(self, key, ttl: int, fetch, priority: int) -> asyncio.Task:
+        """
+        Запускает загрузку ключа, если она еще не идет, и возвращает её задачу.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            # Загрузка идет в отдельной задаче, чтобы отмена одного ожидающего
+            # (например, по таймауту команды) не отменяла её для остальных
+            task = asyncio.ensure_future(fetch(priority))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_fetched(key, ttl, t))
+        return task
+
+    def _on_fetched(self, key, ttl: int, task: asyncio.Task):
+        """
+        Сохраняет результат завершившейся загрузки в кэш.
+        """
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        if isinstance(value, dict) and "error" in value:
+            if value.get("status") != 404:
+                return # Временные ошибки не кэшируем (и не затираем ими устаревший ответ)
+            ttl = self.negative_ttl
+        size = len(json.dumps(value, ensure_ascii=False)) # Примерно столько ответ весил в сети
+        self._pop(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self._bytes += size
+        over_bytes = lambda: self.max_bytes and self._bytes > self.max_bytes
+        while self._entries and (len(self._entries) > self.max_entries or over_bytes()):
+            self._pop(next(iter(self._entries))) # Вытесняем самые давно использованные записи
+            self.stats["evictions"] += 1
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def snapshot(self) -> dict:
+        """
+        Счетчики кэша и его текущий размер - для подбора TTL.
+        """
+        return {**self.stats, "size": len(self._entries), "bytes": self._bytes, "inflight": len(self._inflight)}
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_NEGATIVE_TTL, CACHE_STALE_TTL, CACHE_MAX_BYTES)
+
+CACHE_EVENTS = metrics.gauge("opendota_cache_events", "Счетчики кэша OpenDota с момента запуска", ("event",))
+OPENDOTA_QUEUE = metrics.gauge("opendota_queue_depth", "Запросы, ожидающие разрешения планировщика лимитов")
+
+def collect_opendota_metrics():
+    for event, value in response_cache.snapshot().items():
+        CACHE_EVENTS.set(value, event=event)
+    OPENDOTA_QUEUE.set(opendota.scheduler.queue_depth)
+
+metrics.on_collect.append(collect_opendota_metrics)
+
+def cached_fetch(key, ttl: int, fetch, priority: int, refresh: bool):
+    """
+    Читает ответ через кэш, а при refresh=True принудительно обновляет его.
+    """
+    if refresh:
+        return response_cache.refresh(key, ttl, fetch, priority)
+    return response_cache.get_or_fetch(key, ttl, fetch, priority)
+
 # Функция для получения статистики игрока
-async def get_player_stats(player_id: int):
+async def get_player_stats(player_id: int, priority: int = PRIORITY_INTERACTIVE, refresh: bool = False):
     """
     Получает общую статистику игрока по его ID из OpenDota API.
-    Обрабатывает возможные ошибки API.
     """
-    url = f"https://api.opendota.com/api/players/{player_id}?api_key={OPEN_DOTA_API_KEY}"
-    try:
-        async with aiohttp.ClientSession() as session: # Создаем асинхронную сессию
-            async with session.get(url) as response: # Отправляем GET-запрос
-                if response.status == 200: # Если запрос успешен (код 200 OK)
-                    data = await response.json() # Парсим JSON-ответ
-                    return data
-                elif response.status == 404: # Если игрок не найден
-                    return {"error": "Игрок с таким ID не найден в OpenDota. Проверьте ID."}
-                else: # Другие ошибки API
-                    return {"error": f"Ошибка OpenDota API: {response.status}. Попробуйте позже."}
-    except aiohttp.ClientError: # Ошибка сетевого подключения
-        return {"error": "Не удалось подключиться к OpenDota API. Проверьте интернет-соединение."}
-    except Exception as e: # Любая другая непредвиденная ошибка
-        logging.error(f"Непредвиденная ошибка при получении статистики игрока: {e}")
-        return {"error": "Произошла непредвиденная ошибка. Попробуйте позже."}
+    return await cached_fetch(
+        ("player", player_id), CACHE_TTL["player"],
+        lambda priority: opendota.get_json(
+            f"/players/{player_id}", "статистики игрока",
+            not_found="Игрок с таким ID не найден в OpenDota. Проверьте ID.",
+            priority=priority,
+        ),
+        priority, refresh,
+    )
 
 # Функция для получения винрейта игрока
-async def get_player_win_loss(player_id: int):
+async def get_player_win_loss(player_id: int, priority: int = PRIORITY_INTERACTIVE, refresh: bool = False):
     """
     Получает количество побед и поражений игрока.
     """
-    url = f"https://api.opendota.com/api/players/{player_id}/wl?api_key={OPEN_DOTA_API_KEY}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-return data
-                else:
-                    return {"error": f"Ошибка API при получении W/L: {response.status}"}
-    except aiohttp.ClientError:
-        return {"error": "Ошибка сети при получении W/L."}
-
-# Функция для получения списка героев игрока
-async def get_player_heroes(player_id: int):
-    """
-    Получает список героев, на которых играл игрок, с их статистикой.
-    """
-    url = f"https://api.opendota.com/api/players/{player_id}/heroes?api_key={OPEN_DOTA_API_KEY}"
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data
-                else:
-                    return {"error": f"Ошибка API при получении героев: {response.status}"}
-    except aiohttp.ClientError:
-        return {"error": "Ошибка сети при получении героев."}
-
-# Функция для получения статистики по конкретному герою
-async def get_hero_stats_by_id(hero_id: int):
-    """
-    Получает общую информацию о герое по его ID.
-    """
-    url = f"https://api.opendota.com/api/heroes/{hero_id}?api_key={OPEN_DOTA_API_KEY}"
+    return await cached_fetch(
+        ("wl", player_id), CACHE_TTL["wl"],
+        lambda priority: opendota.get_json(f"/players/{player_id}/wl", "W/L", priority=priority),
+        priority, refresh,
+    )
+
+# --- Параллельная загрузка данных для команд ---
+
+# Заглушка в ответе вместо данных, которые не успели загрузиться
+MISSING = "—"
+
+async def fetch_all(sources: dict, deadline: float = None) -> dict:
+    """
+    Запускает все запросы команды одновременно и ждет их не дольше deadline секунд.
+    sources - словарь {имя: корутина}. Возвращает {имя: результат}; для запросов,
+    которые упали или не успели к сроку, результат - {"error": ..., "status": None}.
+    Не успевшие запросы отменяются (общую загрузку в кэше отмена не прерывает).
+    """
+    deadline = COMMAND_DEADLINE if deadline is None else deadline
+    tasks = {name: asyncio.ensure_future(coro) for name, coro in sources.items()}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data
-                else:
-                    return {"error": f"Ошибка API при получении данных героя: {response.status}"}
-    except aiohttp.ClientError:
-        return {"error": "Ошибка сети при получении данных героя."}
+        done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    finally: # Если отменили саму команду - отменяем и все её запросы
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True) # Дожидаемся, пока отмена отработает
+    results = {}
+    for name, task in tasks.items():
+        if task in pending:
+            results[name] = {"error": "OpenDota не ответил вовремя.", "status": None}
+        elif task.exception() is not None:
+            logging.error(f"Ошибка при загрузке {name}: {task.exception()!r}")
+            results[name] = {"error": "Произошла непредвиденная ошибка. Попробуйте позже.", "status": None}
+        else:
+            results[name] = task.result()
+    return results
+
+def is_error(data) -> bool:
+    """
+    True, если хелпер OpenDota вернул ошибку вместо данных.
+    """
+    return isinstance(data, dict) and "error" in data
+
+# --- Локальная история матчей ---
+
+class PlayerMatches:
+    """
+    Матчи одного игрока в колоночном виде: по массиву на поле, от новых к старым.
+    Так они занимают несколько байт на матч, а не словарь на матч.
+    last_match_id - до какого матча (sync_state) синхронизирована эта копия.
+    """
+    __slots__ = ("match_ids", "hero_ids", "start_times", "wins", "last_match_id")
+
+    def __init__(self, rows=(), last_match_id: int = 0):
+        self.last_match_id = last_match_id
+        self.match_ids = array("q")
+        self.hero_ids = array("H")
+        self.start_times = array("q")
+        self.wins = array("b")
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def extend(self, rows):
+        """
+        Дописывает строки (match_id, hero_id, start_time, win) в конец колонок.
+        """
+        for match_id, hero_id, start_time, win in rows:
+            self.match_ids.append(match_id)
+            self.hero_ids.append(hero_id)
+            self.start_times.append(start_time)
+            self.wins.append(win)
+
+    def prepend(self, newer: "PlayerMatches"):
+        """
+        Добавляет более новые матчи в начало колонок.
+        """
+        self.match_ids = newer.match_ids + self.match_ids
+        self.hero_ids = newer.hero_ids + self.hero_ids
+        self.start_times = newer.start_times + self.start_times
+        self.wins = newer.wins + self.wins
+
+    def hero_stats(self, last_n: int = None, days: int = None) -> list:
+        """
+        Статистика по героям в том же формате, что и /players/{id}/heroes в OpenDota:
+        [{"hero_id": ..., "games": ..., "win": ...}]. Можно ограничить последними
+        last_n играми или последними days днями.
+        """
+        end = len(self.match_ids)
+        if last_n is not None:
+            end = min(end, last_n)
+        if days is not None: # Матчи идут от новых к старым - ищем первый слишком старый
+            since = time.time() - days * 86400
+            end = next((i for i in range(end) if self.start_times[i] < since), end)
+        games = Counter(self.hero_ids[:end])
+        wins = Counter(hero_id for hero_id, win in zip(self.hero_ids[:end], self.wins[:end]) if win)
+        return [{"hero_id": hero_id, "games": count, "win": wins[hero_id]} for hero_id, count in games.items()]
+
+class MatchStore:
+    """
+    Локальная база матчей игроков в SQLite.
+    sync() докачивает из OpenDota только матчи новее последнего сохраненного,
+    matches() отдает их в колоночном виде (с LRU-кэшем в памяти на max_players игроков).
+    """
+
+    def __init__(self, path: str, sync_interval: int, max_players: int):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_players = max_players
+        self._db = None
+        self._db_lock = threading.Lock() # Запросы к SQLite выполняются в потоках - по одному за раз
+        self._memory = OrderedDict() # account_id -> PlayerMatches
+        self._syncing = {} # account_id -> задача синхронизации (один запрос на игрока)
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            " account_id INTEGER NOT NULL, match_id INTEGER NOT NULL, hero_id INTEGER NOT NULL,"
+            " start_time INTEGER NOT NULL, win INTEGER NOT NULL,"
+            " PRIMARY KEY (account_id, match_id)) WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            " account_id INTEGER PRIMARY KEY, last_match_id INTEGER NOT NULL, synced_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS watchlist ("
+            " chat_id INTEGER NOT NULL, account_id INTEGER NOT NULL, added_at REAL NOT NULL,"
+            " PRIMARY KEY (chat_id, account_id)) WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def _sync_state(self, account_id: int):
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT last_match_id, synced_at FROM sync_state WHERE account_id = ?", (account_id,)
+            ).fetchone()
+
+    def _save(self, account_id: int, rows: list, last_match_id: int, synced_at: float):
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO matches (account_id, match_id, hero_id, start_time, win) VALUES (?, ?, ?, ?, ?)",
+                [(account_id, *row) for row in rows],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sync_state (account_id, last_match_id, synced_at) VALUES (?, ?, ?)",
+                (account_id, last_match_id, synced_at),
+            )
+            self._db.commit()
+
+    def _load(self, account_id: int) -> PlayerMatches:
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT match_id, hero_id, start_time, win FROM matches WHERE account_id = ? ORDER BY match_id DESC",
+                (account_id,),
+            ).fetchall()
+            state = self._db.execute(
+                "SELECT last_match_id FROM sync_state WHERE account_id = ?", (account_id,)
+            ).fetchone()
+        return PlayerMatches(rows, state[0] if state is not None else 0)
+
+    def _drop_if_behind(self, account_id: int, last_match_id: int):
+        """
+        Забывает копию матчей в памяти, если база ушла вперед (игрока
+        синхронизировал другой процесс) - matches() перечитает её из базы.
+        """
+        cached = self._memory.get(account_id)
+        if cached is not None and cached.last_match_id < last_match_id:
+            del self._memory[account_id]
+
+    def _add_watch(self, chat_id: int, account_id: int, limit: int) -> bool:
+        with self._db_lock:
+            count = self._db.execute("SELECT COUNT(*) FROM watchlist WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+            exists = self._db.execute(
+                "SELECT 1 FROM watchlist WHERE chat_id = ? AND account_id = ?", (chat_id, account_id)
+            ).fetchone()
+            if exists is None and count >= limit:
+                return False
+            self._db.execute(
+                "INSERT OR IGNORE INTO watchlist (chat_id, account_id, added_at) VALUES (?, ?, ?)",
+                (chat_id, account_id, time.time()),
+            )
+            self._db.commit()
+            return True
+
+    def _remove_watch(self, chat_id: int, account_id: int) -> bool:
+        with self._db_lock:
+            removed = self._db.execute(
+                "DELETE FROM watchlist WHERE chat_id = ? AND account_id = ?", (chat_id, account_id)
+            ).rowcount
+            self._db.commit()
+            return removed > 0
+
+    def _watched(self, chat_id: int = None, index: int = 0, workers: int = 1) -> list:
+        with self._db_lock:
+            if chat_id is None:
+                rows = self._db.execute("SELECT DISTINCT chat_id, account_id FROM watchlist").fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT chat_id, account_id FROM watchlist WHERE chat_id = ? ORDER BY added_at", (chat_id,)
+                ).fetchall()
+        # Остаток считаем в Python, как роутер webhook: у SQLite он другой для отрицательных ID групп
+        accounts = [account_id for chat, account_id in rows if chat % workers == index]
+        return list(dict.fromkeys(accounts))
+
+    async def add_watch(self, chat_id: int, account_id: int, limit: int) -> bool:
+        """
+        Добавляет игрока в список наблюдения чата. False, если в чате уже limit игроков.
+        """
+        return await asyncio.to_thread(self._add_watch, chat_id, account_id, limit)
+
+    async def remove_watch(self, chat_id: int, account_id: int) -> bool:
+        return await asyncio.to_thread(self._remove_watch, chat_id, account_id)
+
+    async def watched(self, chat_id: int = None, index: int = 0, workers: int = 1) -> list:
+        """
+        Игроки из списка наблюдения чата (или всех чатов, если chat_id не указан).
+        index и workers оставляют только чаты, которые обслуживает этот процесс webhook-режима.
+        """
+        return await asyncio.to_thread(self._watched, chat_id, index, workers)
+
+    async def sync(self, account_id: int, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Докачивает новые матчи игрока. Возвращает None или словарь с ошибкой.
+        Одновременные вызовы для одного игрока ждут одну общую синхронизацию,
+        и её не прерывает отмена команды, которая её запустила.
+        """
+        task = self._syncing.get(account_id)
+        if task is None:
+            task = asyncio.ensure_future(self._sync(account_id, priority))
+            self._syncing[account_id] = task
+            task.add_done_callback(lambda t: self._syncing.pop(account_id, None))
+        return await asyncio.shield(task)
+
+    async def _sync(self, account_id: int, priority: int):
+        state = await asyncio.to_thread(self._sync_state, account_id)
+        now = time.time()
+        if state is not None:
+            self._drop_if_behind(account_id, state[0])
+        if state is not None and now - state[1] < self.sync_interval:
+            return None # Синхронизировались недавно - в OpenDota не ходим
+        # Берем только нужные поля, а при повторной синхронизации - только последние дни
+        params = [("project", field) for field in ("hero_id", "start_time", "player_slot", "radiant_win")]
+        last_match_id = 0
+        if state is not None:
+            last_match_id = state[0]
+            params.append(("date", int((now - state[1]) // 86400) + 1))
+        data = await opendota.get_json(
+            f"/players/{account_id}/matches", "истории матчей",
+            not_found="Игрок с таким ID не найден в OpenDota. Проверьте ID.",
+            priority=priority, params=params,
+        )
+        if is_error(data):
+            return data
+        rows = []
+        for match in data:
+            match_id = match.get("match_id")
+            if match_id is None or match_id <= last_match_id or match.get("hero_id") is None:
+                continue
+            is_radiant = (match.get("player_slot") or 0) < 128 # Слоты 0-127 - Radiant, 128+ - Dire
+            win = 1 if is_radiant == bool(match.get("radiant_win")) else 0
+            rows.append((match_id, match["hero_id"], match.get("start_time") or 0, win))
+        rows.sort(reverse=True) # От новых к старым, как в колонках
+        new_last_match_id = rows[0][0] if rows else last_match_id
+        await asyncio.to_thread(self._save, account_id, rows, new_last_match_id, now)
+        self._drop_if_behind(account_id, last_match_id) # Пока ждали OpenDota, база могла уйти вперед
+        cached = self._memory.get(account_id)
+        if cached is not None:
+            if rows:
+                cached.prepend(PlayerMatches(rows))
+            cached.last_match_id = new_last_match_id
+        return None
+
+    async def matches(self, account_id: int) -> PlayerMatches:
+        """
+        Все сохраненные матчи игрока (из памяти или из базы).
+        """
+        cached = self._memory.get(account_id)
+        if cached is None:
+            cached = await asyncio.to_thread(self._load, account_id)
+            self._memory[account_id] = cached
+            while len(self._memory) > self.max_players:
+                self._memory.popitem(last=False)
+        self._memory.move_to_end(account_id)
+        return cached
+
+match_store = MatchStore(MATCHES_DB_PATH, MATCHES_SYNC_INTERVAL, MATCHES_MEMORY_PLAYERS)
+
+def parse_match_filter(text: str):
+    """
+    Разбирает фильтр матчей из аргумента команды: "20" - последние 20 игр,
+    "30d" или "30д" - последние 30 дней. Возвращает (last_n, days) или None.
+    """
+    found = re.fullmatch(r"(\d{1,4})\s*([dд]?)", text.strip().lower())
+    if not found or int(found.group(1)) == 0:
+        return None
+    if found.group(2):
+        return None, int(found.group(1))
+    return int(found.group(1)), None
+
+# Приписка к ответу, если новые матчи скачать не удалось и считаем по старым
+STALE_MATCHES_NOTE = "\n<i>Не удалось обновить историю матчей, данные могут быть устаревшими.</i>"
+
+def describe_match_filter(last_n: int = None, days: int = None) -> str:
+    """
+    Текст фильтра для заголовка ответа.
+    """
+    if last_n is not None:
+        return f", последние {last_n} игр"
+    if days is not None:
+        return f", последние {days} дн."
+    return ""
+
+async def load_player_hero_stats(player_id: int, last_n: int = None, days: int = None, deadline: float = None):
+    """
+    Синхронизирует историю матчей игрока и считает по ней статистику героев.
+    Возвращает (список героев, ошибка или None). Если синхронизация не удалась,
+    но в базе уже есть матчи, отдает их вместе с ошибкой.
+    """
+    sync_error = (await fetch_all({"matches": match_store.sync(player_id)}, deadline))["matches"]
+    matches = await match_store.matches(player_id)
+    if sync_error is not None and not len(matches):
+        return None, sync_error
+    return matches.hero_stats(last_n, days), sync_error
+
+# --- Справочник героев ---
+
+# Дополнительные названия героев: русские имена и сленг, которые пишут в чатах.
+# Ключ - внутреннее имя героя из OpenDota без префикса npc_dota_hero_.
+HERO_ALIASES = {
+    "antimage": ["антимаг", "ам", "am"],
+    "axe": ["акс"],
+    "bane": ["бейн"],
+    "bloodseeker": ["бладсикер", "блудсикер", "bs"],
+    "crystal_maiden": ["цм", "кристал", "кристалка", "cm"],
+    "drow_ranger": ["дровка", "дроу", "drow"],
+    "earthshaker": ["шейкер", "шейк"],
+    "juggernaut": ["джаггернаут", "джагернаут", "джагер", "jugg"],
+    "mirana": ["мирана", "potm"],
+    "morphling": ["морфлинг", "морф", "morph"],
+    "nevermore": ["сф", "невермор", "sf"],
+    "phantom_lancer": ["пл", "фантом лансер", "pl"],
+    "puck": ["пак"],
+    "pudge": ["пудж", "пуджик"],
+    "razor": ["разор", "рейзор"],
+    "sand_king": ["сенд кинг", "сэнд кинг", "sk"],
+    "storm_spirit": ["шторм", "штормспирит", "storm"],
+    "sven": ["свен"],
+    "tiny": ["тини", "тиня"],
+    "vengefulspirit": ["венга", "венгфул", "vs"],
+    "windrunner": ["виндраннер", "виндрейнджер", "вр", "wr"],
+    "zuus": ["зевс", "zeus"],
+    "kunkka": ["кунка", "кункка"],
+    "lina": ["лина"],
+    "lion": ["лион", "лев"],
+    "shadow_shaman": ["шаман", "раста", "rasta"],
+    "slardar": ["слардар"],
+    "tidehunter": ["тайдхантер", "тайд", "tide"],
+    "witch_doctor": ["вд", "витч доктор", "wd"],
+    "lich": ["лич"],
+    "riki": ["рики"],
+    "enigma": ["энигма"],
+    "tinker": ["тинкер"],
+    "sniper": ["снайпер"],
+    "necrolyte": ["некрофос", "некр", "necro"],
+    "warlock": ["варлок"],
+    "beastmaster": ["бистмастер", "бист", "bm"],
+    "queenofpain": ["квопа", "квинка", "qop"],
+    "venomancer": ["веномансер", "веник", "veno"],
+    "faceless_void": ["войд", "фв", "void", "fv"],
+    "skeleton_king": ["вк", "врейт кинг", "скелет", "wk"],
+    "death_prophet": ["дп", "дез профет", "dp"],
+    "phantom_assassin": ["фантомка", "па", "pa"],
+    "pugna": ["пугна"],
+    "templar_assassin": ["темпларка", "та", "ta"],
+    "viper": ["вайпер"],
+    "luna": ["луна"],
+    "dragon_knight": ["дк", "драгон кнайт", "dk"],
+    "dazzle": ["даззл", "дазл"],
+    "rattletrap": ["клокверк", "клок", "clock"],
+    "leshrac": ["лешрак", "леший"],
+    "furion": ["профет", "фурион", "np"],
+    "life_stealer": ["лайфстилер", "гуль", "naix"],
+    "dark_seer": ["дарк сир", "ds"],
+    "clinkz": ["клинкз", "клинкс"],
+    "omniknight": ["омникнайт", "омник", "omni"],
+    "enchantress": ["энчантресс", "энча", "ench"],
+    "huskar": ["хускар"],
+    "night_stalker": ["найт сталкер", "нс", "ns"],
+    "broodmother": ["бруда", "бруд", "brood"],
+    "bounty_hunter": ["баунти", "bh"],
+    "weaver": ["вивер"],
+    "jakiro": ["джакиро"],
+    "batrider": ["бэтрайдер", "бэт", "bat"],
+    "chen": ["чен"],
+    "spectre": ["спектра", "спектр", "spec"],
+    "ancient_apparition": ["аа", "апарат", "aa"],
+    "doom_bringer": ["дум", "doom"],
+    "ursa": ["урса"],
+    "spirit_breaker": ["бара", "спирит брейкер", "sb"],
+    "gyrocopter": ["гирокоптер", "гиро", "gyro"],
+    "alchemist": ["алхимик", "алх", "alch"],
+    "invoker": ["инвокер", "инвок", "voker"],
+    "silencer": ["сайленсер"],
+    "obsidian_destroyer": ["од", "аутворлд", "od"],
+    "lycan": ["ликан"],
+    "brewmaster": ["брюмастер", "панда", "brew"],
+    "shadow_demon": ["шадоу демон", "сд", "sd"],
+    "lone_druid": ["лон друид", "друид", "ld"],
+    "chaos_knight": ["хаос", "хаос кнайт", "ck"],
+    "meepo": ["мипо"],
+    "treant": ["трент", "treant"],
+    "ogre_magi": ["огр", "огр маги", "ogre"],
+    "undying": ["андаинг", "ундинг", "dirge"],
+    "rubick": ["рубик"],
+    "disruptor": ["дизраптор"],
+    "nyx_assassin": ["никс", "nyx"],
+    "naga_siren": ["нага", "naga"],
+    "keeper_of_the_light": ["котл", "kotl"],
+    "wisp": ["висп", "ио", "io"],
+    "visage": ["визаж"],
+    "slark": ["сларк"],
+    "medusa": ["медуза", "дуза", "dusa"],
+    "troll_warlord": ["тролль", "тролль варлорд", "troll"],
+    "centaur": ["кентавр", "цента", "centaur"],
+    "magnataur": ["магнус", "magnus"],
+    "shredder": ["тимбер", "тимберсо", "timber"],
+    "bristleback": ["бристлбек", "бристл", "bb"],
+    "tusk": ["туск"],
+    "skywrath_mage": ["скайрат", "скай", "sky"],
+    "abaddon": ["абаддон", "аба", "abba"],
+    "elder_titan": ["элдер титан", "титан", "et"],
+    "legion_commander": ["легионка", "легион", "lc"],
+    "techies": ["течис", "минер"],
+    "ember_spirit": ["эмбер", "ember"],
+    "earth_spirit": ["ерс спирит", "земляной", "kaolin"],
+    "abyssal_underlord": ["андерлорд", "питлорд", "underlord"],
+    "terrorblade": ["терорблейд", "тб", "tb"],
+    "phoenix": ["феникс"],
+    "oracle": ["оракл"],
+    "winter_wyvern": ["виверна", "ww"],
+    "arc_warden": ["арк варден", "зет", "arc"],
+    "monkey_king": ["манки кинг", "мк", "mk"],
+    "dark_willow": ["дарк виллоу", "вилоу", "dw"],
+    "pangolier": ["панголиер", "панго", "pango"],
+    "grimstroke": ["гримстрок", "грим"],
+    "hoodwink": ["худвинк", "белка"],
+    "void_spirit": ["войд спирит", "воид спирит"],
+    "snapfire": ["снапфаер", "бабка"],
+    "mars": ["марс"],
+    "dawnbreaker": ["доунбрейкер", "дб"],
+    "marci": ["марси"],
+    "primal_beast": ["праймал бист", "праймал"],
+    "muerta": ["муэрта"],
+    "ringmaster": ["рингмастер"],
+    "kez": ["кез"],
+}
+
+def normalize_hero_query(text: str) -> str:
+    """
+    Приводит имя героя к виду для поиска: нижний регистр, без пробелов и знаков.
+    "Anti-Mage" -> "antimage", "Ёжик" -> "ежик".
+    """
+    return "".join(ch for ch in text.lower().replace("ё", "е") if ch.isalnum())
+
+class HeroCatalog:
+    """
+    Список всех героев Dota 2 с быстрым поиском.
+    Загружается из локального файла при старте, обновляется из OpenDota в фоне.
+    name() - O(1) по ID, find() - по имени, алиасу, префиксу или с опечаткой.
+    """
+
+    # Пауза между попытками загрузить справочник, пока он пуст, сек (растет вдвое до максимума)
+    RETRY_MIN = 30
+    RETRY_MAX = 900
+
+    def __init__(self, path: str, refresh_interval: int):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._names = {} # hero_id -> отображаемое имя
+        self._aliases = {} # нормализованный алиас -> hero_id
+        self._sorted_aliases = [] # отсортированные алиасы для поиска по префиксу
+        self._refresh_task = None
+
+    def __len__(self):
+        return len(self._names)
+
+    async def start(self):
+        """
+        Загружает справочник из файла (или из API, если файла нет) и запускает фоновое обновление.
+        """
+        age = self._load_file()
+        if age is None: # Без файла искать героев не по чему - ждем API
+            delay = self.refresh_interval if await self.refresh() else self.RETRY_MIN
+        else: # Устаревший файл тоже годится: обновим его в фоне, не задерживая запуск
+            delay = self.refresh_interval - age
+        self._refresh_task = asyncio.ensure_future(self._refresh_loop(delay))
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    def _load_file(self):
+        """
+        Читает справочник из файла. Возвращает возраст файла в секундах или None, если файла нет.
+        """
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                heroes = json.load(f)
+            age = time.time() - os.path.getmtime(self.path)
+        except (OSError, ValueError):
+            return None
+        self._build(heroes)
+        return age
+
+    async def refresh(self) -> bool:
+        """
+        Загружает актуальный список героев из OpenDota и сохраняет его в файл.
+        Возвращает True, если список обновлен.
+        """
+        heroes = await opendota.get_json("/heroes", "списка героев", priority=PRIORITY_BACKGROUND)
+        if not isinstance(heroes, list) or not heroes:
+            logging.warning(f"Не удалось обновить список героев: {heroes}")
+            return False
+        self._build(heroes)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp" # Свой файл у каждого процесса webhook-режима
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(heroes, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path) # Атомарно подменяем файл, чтобы не оставить его битым
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить список героев в {self.path}: {e}")
+        logging.info(f"Список героев обновлен: {len(self._names)} героев")
+        return True
+
+    async def _refresh_loop(self, first_delay: float):
+        delay = max(first_delay, 0)
+        retry = self.RETRY_MIN
+        while True:
+            await asyncio.sleep(delay)
+            if await self.refresh() or self._names:
+                delay, retry = self.refresh_interval, self.RETRY_MIN
+            else: # Без справочника /hero не работает - пробуем снова скоро
+                retry = min(retry * 2, self.RETRY_MAX)
+                delay = retry
+
+    def _build(self, heroes: list):
+        """
+        Строит индексы по списку героев из OpenDota (/heroes).
+        Приоритет алиасов: ручные из HERO_ALIASES, затем имена, затем аббревиатуры.
+        Аббревиатуры, которые подходят нескольким героям, не используются.
+        """
+        names = {}
+        aliases = {}
+        generated = {}
+        ambiguous = set()
+        short_names = {}
+        for hero in heroes:
+            hero_id = hero.get("id")
+            localized = hero.get("localized_name")
+            if hero_id is None or not localized:
+                continue
+            names[hero_id] = localized
+            short_names[hero_id] = (hero.get("name") or "").replace("npc_dota_hero_", "")
+        # Сначала ручные алиасы всех героев, потом имена - иначе порядок в /heroes решал бы спорные случаи
+        for hero_id, short_name in short_names.items():
+            for alias in HERO_ALIASES.get(short_name, []):
+                key = normalize_hero_query(alias)
+                if key:
+                    aliases.setdefault(key, hero_id)
+        for hero_id, localized in names.items():
+            for alias in (localized, short_names[hero_id]):
+                key = normalize_hero_query(alias)
+                if key:
+                    aliases.setdefault(key, hero_id)
+            words = localized.replace("-", " ").split()
+            if len(words) > 1: # Аббревиатура по первым буквам: "Shadow Fiend" -> "sf"
+                initials = normalize_hero_query("".join(word[0] for word in words))
+                if generated.get(initials, hero_id) != hero_id:
+                    ambiguous.add(initials)
+                generated[initials] = hero_id
+        for key, hero_id in generated.items():
+            if key not in ambiguous:
+                aliases.setdefault(key, hero_id)
+        self._names = names
+        self._aliases = aliases
+        self._sorted_aliases = sorted(aliases)
+
+    def name(self, hero_id: int) -> str:
+        """
+        Имя героя по ID (или заглушка, если героя нет в справочнике).
+        """
+        return self._names.get(hero_id, f"Герой ID {hero_id}")
+
+    def find(self, query: str):
+        """
+        Ищет героя по тексту пользователя.
+        Возвращает (hero_id, []) если герой найден однозначно,
+        (None, [имена]) если подходит несколько героев и (None, []) если ничего не найдено.
+        """
+        query = query.strip()
+        if query.isdigit(): # ID героя по-прежнему можно указать числом
+            return int(query), []
+        key = normalize_hero_query(query)
+        if not key:
+            return None, []
+        if key in self._aliases: # Точное совпадение с именем или алиасом
+            return self._aliases[key], []
+        matches = self.complete(key)
+        if len(matches) == 1:
+            return matches[0], []
+        if matches:
+            return None, [self.name(hero_id) for hero_id in matches]
+        close = difflib.get_close_matches(key, self._sorted_aliases, n=1, cutoff=0.75) # Опечатки
+        if close:
+            return self._aliases[close[0]], []
+        return None, []
+
+    def complete(self, prefix: str, limit: int = 5) -> list:
+        """
+        ID героев, у которых имя или алиас начинается с prefix (без повторов).
+        """
+        prefix = normalize_hero_query(prefix)
+        if not prefix:
+            return []
+        found = []
+        index = bisect.bisect_left(self._sorted_aliases, prefix)
+        while index < len(self._sorted_aliases) and self._sorted_aliases[index].startswith(prefix):
+            hero_id = self._aliases[self._sorted_aliases[index]]
+            if hero_id not in found:
+                found.append(hero_id)
+                if len(found) >= limit:
+                    break
+            index += 1
+        return found
+
+hero_catalog = HeroCatalog(HEROES_FILE, HEROES_REFRESH_INTERVAL)
+
+# --- Фоновый прогрев данных популярных игроков ---
+
+class PrefetchScheduler:
+    """
+    Узнает по командам пользователей, какие игроки сейчас популярны, и вместе
+    с игроками из /watch заранее обновляет их статистику, W/L и историю матчей.
+    Популярность - счетчик запросов, который затухает вдвое за half_life секунд.
+    Чем популярнее игрок, тем чаще он обновляется; остывшие игроки забываются.
+    На прогрев тратится не больше quota_share от квоты OpenDota, и только когда
+    в очереди нет интерактивных запросов.
+    """
+
+    # Сколько запросов к OpenDota уходит на обновление одного игрока
+    CALLS_PER_PLAYER = 3
+
+    def __init__(self, tick: float, half_life: float, hot_score: float, cold_score: float,
+                 min_interval: float, max_interval: float, watch_interval: float,
+                 quota_share: float, max_players: int):
+        self.tick = tick
+        self.half_life = half_life
+        self.hot_score = hot_score
+        self.cold_score = cold_score
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.watch_interval = watch_interval
+        self.quota_share = quota_share
+        self.max_players = max_players
+        # В режиме webhook игроков из /watch прогревает процесс, который обслуживает следивший чат
+        # (chat_id % workers): кэш ответов у каждого процесса свой
+        self.index = 0
+        self.workers = 1
+        self._players = {} # player_id -> [популярность, когда обновлена популярность, когда обновлять данные]
+        self._watched = set()
+        self._task = None
+
+    def _score(self, entry: list, now: float) -> float:
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def record(self, player_id: int):
+        """
+        Отмечает запрос игрока пользователем.
+        """
+        now = time.monotonic()
+        entry = self._players.get(player_id)
+        if entry is None:
+            if len(self._players) >= self.max_players: # Освобождаем место, забывая самого холодного
+                coldest = min(self._players, key=lambda pid: self._score(self._players[pid], now))
+                del self._players[coldest]
+            entry = self._players[player_id] = [0.0, now, now + self.min_interval]
+        entry[0] = self._score(entry, now) + 1
+        entry[1] = now
+
+    async def _load_watched(self) -> set:
+        return set(await match_store.watched(index=self.index, workers=self.workers))
+
+    def watch(self, player_id: int):
+        self._watched.add(player_id)
+        self._players.setdefault(player_id, [0.0, time.monotonic(), 0.0])[2] = 0.0 # Прогреть в ближайший тик
+
+    def _interval(self, player_id: int, score: float) -> float:
+        interval = max(self.min_interval, self.max_interval / (1 + score))
+        if player_id in self._watched:
+            interval = min(interval, self.watch_interval)
+        return interval
+
+    async def start(self):
+        self._watched = await self._load_watched()
+        for player_id in self._watched:
+            self.watch(player_id)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self._tick()
+            except Exception as e: # Ошибка прогрева не должна останавливать планировщик
+                logging.error(f"Ошибка фонового прогрева: {e!r}")
+
+    async def _tick(self):
+        self._watched = await self._load_watched() # Список мог поменяться в другом процессе
+        now = time.monotonic()
+        due = []
+        for player_id, entry in list(self._players.items()):
+            score = self._score(entry, now)
+            watched = player_id in self._watched
+            if score < self.cold_score and not watched:
+                del self._players[player_id] # Игрок остыл
+            elif (watched or score >= self.hot_score) and entry[2] <= now:
+                due.append((score, player_id))
+        for player_id in self._watched - set(self._players):
+            self.watch(player_id)
+        PREFETCH_TRACKED.set(len(self._players))
+        scheduler = opendota.scheduler
+        if not due or scheduler.queue_depth > scheduler.max_queue // 4: # Пользователи важнее прогрева
+            return
+        budget = int(scheduler.rate * self.tick * self.quota_share) // self.CALLS_PER_PLAYER
+        due.sort(reverse=True) # Самые популярные - первыми
+        batch = [player_id for _, player_id in due[:max(budget, 1)]]
+        for player_id in batch:
+            entry = self._players[player_id]
+            entry[2] = now + self._interval(player_id, self._score(entry, now))
+        await asyncio.gather(*(self._refresh(player_id) for player_id in batch))
+
+    async def _refresh(self, player_id: int):
+        results = await fetch_all({
+            "stats": get_player_stats(player_id, PRIORITY_BACKGROUND, refresh=True),
+            "wl": get_player_win_loss(player_id, PRIORITY_BACKGROUND, refresh=True),
+            "matches": match_store.sync(player_id, PRIORITY_BACKGROUND),
+        }, deadline=max(self.tick * 4, 60))
+        failed = any(is_error(result) for result in results.values())
+        PREFETCH_REFRESHES.inc(status="error" if failed else "ok")
+
+PREFETCH_TRACKED = metrics.gauge("prefetch_tracked_players", "Игроки, популярность которых отслеживается")
+PREFETCH_REFRESHES = metrics.counter("prefetch_refreshes_total", "Фоновые обновления игроков", ("status",))
+
+prefetcher = PrefetchScheduler(
+    PREFETCH_TICK, PREFETCH_HALF_LIFE, PREFETCH_HOT_SCORE, PREFETCH_COLD_SCORE,
+    PREFETCH_MIN_INTERVAL, PREFETCH_MAX_INTERVAL, PREFETCH_WATCH_INTERVAL,
+    PREFETCH_QUOTA_SHARE, PREFETCH_MAX_PLAYERS,
+)
 
 # --- Вспомогательные функции для форматирования данных ---
 
@@ -141,6 +1752,142 @@ def get_rank_tier_name(rank_tier: int):
         return f"{rank_names[tier]} {stars}"
     return "Неизвестно"
 
+# --- Отправка сообщений в Telegram ---
+
+class SendPacer:
+    """
+    Ограничитель частоты отправки по алгоритму GCRA: хранит одно число на чат
+    и позволяет короткий всплеск из burst сообщений. reserve() сразу резервирует
+    место в очереди и возвращает, сколько секунд нужно подождать.
+    """
+    __slots__ = ("interval", "tolerance", "next_at")
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.next_at = 0.0 # Теоретическое время следующей отправки
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        at = max(self.next_at, now)
+        self.next_at = at + self.interval
+        return max(0.0, at - self.tolerance - now)
+
+    def pause(self, seconds: float):
+        self.next_at = max(self.next_at, time.monotonic() + seconds + self.tolerance)
+
+class Outbox:
+    """
+    Все исходящие сообщения бота идут через этот класс: он соблюдает общий лимит
+    Telegram и лимит на чат, а при RetryAfter ждет и повторяет отправку сам.
+    respond() заменяет пару "Загружаю..." + ответ на одно сообщение и его правку.
+    """
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float,
+                 placeholder_delay: float, max_chats: int = 10000, max_retries: int = 3):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.placeholder_delay = placeholder_delay
+        self.max_chats = max_chats
+        self.max_retries = max_retries
+        self._global = SendPacer(global_rate, burst=max(1, int(global_rate)))
+        self._chats = OrderedDict() # chat_id -> SendPacer, давно молчащие чаты вытесняются
+
+    def _chat_pacer(self, chat: types.Chat) -> SendPacer:
+        pacer = self._chats.get(chat.id)
+        if pacer is None:
+            is_group = chat.type in (types.ChatType.GROUP, types.ChatType.SUPERGROUP, types.ChatType.CHANNEL)
+            pacer = SendPacer(self.group_rate if is_group else self.private_rate, burst=3)
+            self._chats[chat.id] = pacer
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat.id)
+        return pacer
+
+    async def call(self, chat: types.Chat, method: str, send):
+        """
+        Выполняет вызов Telegram API send() (корутина-функция) с учетом лимитов.
+        method - название метода Bot API для метрик. chat=None - вызов не в чат
+        (например, ответ на inline-запрос), для него действует только общий лимит.
+        """
+        attempt = 0
+        while True:
+            waited_from = time.perf_counter()
+            pacer = self._chat_pacer(chat) if chat is not None else None
+            delay = max(pacer.reserve() if pacer is not None else 0.0, self._global.reserve())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = time.perf_counter()
+            TELEGRAM_WAIT.observe(started - waited_from, method=method)
+            status = "error"
+            try:
+                result = await send()
+                status = "ok"
+                return result
+            except RetryAfter as e: # Telegram просит подождать - ждем и пробуем снова
+                status = "retry_after"
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logging.warning(f"Telegram ограничил {method} (чат {chat.id if chat else '-'}), ждем {e.timeout} с")
+                if pacer is not None:
+                    pacer.pause(e.timeout)
+                self._global.pause(e.timeout) # Flood-wait касается всего бота, а не только этого чата
+            finally:
+                TELEGRAM_REQUESTS.inc(method=method, status=status)
+                TELEGRAM_DURATION.observe(time.perf_counter() - started, method=method)
+                trace_span("telegram", method, waited_from, status=status,
+                           queue_ms=round((started - waited_from) * 1000, 1))
+
+    async def reply(self, message: types.Message, text: str) -> types.Message:
+        return await self.call(message.chat, "sendMessage", lambda: message.reply(text))
+
+    async def answer_inline(self, query: types.InlineQuery, results: list, cache_time: int, **kwargs) -> bool:
+        """
+        Отвечает на inline-запрос. Это не отправка в чат, поэтому лимиты чатов
+        не действуют: промедление только повышает шанс, что запрос устареет.
+        """
+        return await self.call(None, "answerInlineQuery",
+                               lambda: query.answer(results, cache_time=cache_time, **kwargs))
+
+    async def edit(self, sent: types.Message, text: str, reply_to: types.Message) -> types.Message:
+        """
+        Заменяет текст уже отправленного сообщения. Если править нельзя (например,
+        сообщение удалили), отправляет новый ответ на reply_to.
+        """
+        try:
+            return await self.call(sent.chat, "editMessageText", lambda: sent.edit_text(text))
+        except MessageNotModified:
+            return sent
+        except (MessageToEditNotFound, MessageCantBeEdited):
+            return await self.reply(reply_to, text)
+
+    async def respond(self, message: types.Message, placeholder: str, produce) -> types.Message:
+        """
+        Отвечает на message результатом корутины produce (текстом ответа).
+        Если ответ готов за placeholder_delay секунд, уходит одно сообщение;
+        иначе сначала отправляется placeholder, а потом он правится на ответ.
+        """
+        task = asyncio.ensure_future(produce)
+        try:
+            done, _ = await asyncio.wait({task}, timeout=self.placeholder_delay)
+            if done:
+                return await self.reply(message, self._result_text(task))
+            sent = await self.reply(message, placeholder)
+            await asyncio.wait({task})
+            return await self.edit(sent, self._result_text(task), message)
+        finally:
+            task.cancel() # Если отменили саму команду, не оставляем загрузку висеть
+
+    @staticmethod
+    def _result_text(task: asyncio.Task) -> str:
+        if task.exception() is not None:
+            logging.error(f"Ошибка при подготовке ответа: {task.exception()!r}")
+            return "Произошла непредвиденная ошибка. Попробуйте позже."
+        return task.result()
+
+outbox = Outbox(TELEGRAM_GLOBAL_RATE, TELEGRAM_PRIVATE_RATE, TELEGRAM_GROUP_RATE, PLACEHOLDER_DELAY)
+
 # --- Обработчики команд Telegram ---
 
 @dp.message_handler(commands=['start'])
@@ -148,7 +1895,8 @@ async def send_welcome(message: types.Message):
     """
     Обработчик команды /start. Отправляет приветствие и инструкцию.
     """
-    await message.reply(
+    await outbox.reply(
+        message,
         "Привет! Я бот для получения статистики по Dota 2.\n"
         "Используй команду /help для получения списка команд."
     )
@@ -158,14 +1906,41 @@ async def send_help(message: types.Message):
     """
     Обработчик команды /help. Отправляет список доступных команд.
     """
-    await message.reply(
+    await outbox.reply(
+        message,
         "<b>Доступные команды:</b>\n"
         "/profile [ID игрока] - получить общую статистику игрока.\n"
-        "/top [ID игрока] - получить статистику по лучшим героям игрока.\n"
-        "/hero [ID игрока] [Имя героя] - получить статистику по конкретному герою.\n"
+        "/top [ID игрока] [20 | 30d] - получить статистику по лучшим героям игрока (можно за последние N игр или дней).\n"
+        "/hero [ID игрока] [Имя героя] [20 | 30d] - получить статистику по конкретному герою.\n"
+        "/watch [ID игрока] - следить за игроком: его статистика будет обновляться заранее.\n"
+        "/unwatch [ID игрока] - перестать следить за игроком. /watchlist - список наблюдения.\n"
+        "/compare [ID] [ID] ... - сравнить до 10 игроков в одной таблице.\n"
+        "/party - сравнить игроков из списка наблюдения (или /party [ID] [ID] ...).\n"
+        "В любом чате: @имя_бота [ID игрока] [Имя героя] - отправить статистику прямо в переписку.\n"
         "<i>ID игрока можно найти на сайте OpenDota или в клиенте Dota 2.</i>"
     )
 
+@dp.message_handler(commands=['cachestats'])
+async def cmd_cache_stats(message: types.Message):
+    """
+    Служебная команда /cachestats: показывает счетчики кэша OpenDota. Только для админов.
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    stats = response_cache.snapshot()
+    served = stats["hits"] + stats["negative_hits"] + stats["stale_hits"] + stats["coalesced"]
+    lookups = served + stats["misses"]
+    hit_rate = (served / lookups * 100) if lookups > 0 else 0
+    await outbox.reply(
+        message,
+        "<b>Кэш OpenDota:</b>\n"
+        f"Попаданий: {stats['hits']} (из них «не найден»: {stats['negative_hits']}), устаревших: {stats['stale_hits']}\n"
+        f"Фоновых обновлений: {stats['refreshes']}\n"
+        f"Промахов: {stats['misses']}, объединено запросов: {stats['coalesced']}\n"
+        f"Вытеснено: {stats['evictions']}, записей: {stats['size']} ({stats['bytes'] // 1024} КБ), загружается: {stats['inflight']}\n"
+        f"Доля запросов без обращения к API: {hit_rate:.1f}%"
+    )
+
 # --- Обработчик для команды /profile ---
 @dp.message_handler(commands=['profile'])
 async def cmd_profile(message: types.Message, state: FSMContext):
@@ -178,63 +1953,88 @@ async def cmd_profile(message: types.Message, state: FSMContext):
             player_id = int(args)
             await process_player_profile(message, player_id)
         except ValueError:
-            await message.reply("Неверный формат ID игрока. ID должен быть числом.")
-    else: # Если ID не передан, запрашиваем его await message.reply("Пожалуйста, введите ID игрока для получения профиля.")
+            await outbox.reply(message, "Неверный формат ID игрока. ID должен быть числом.")
+    else: # Если ID не передан, запрашиваем его
+        await outbox.reply(message, "Пожалуйста, введите ID игрока для получения профиля.")
         await Form.player_id.set() # Устанавливаем состояние ожидания ID
+        await state.update_data(command="profile") # Запоминаем, для какой команды ждем ID
 
-# Обработчик для получения ID игрока, когда бот находится в состоянии Form.player_id
+# Обработчик для получения ID игрока, когда бот находится в состоянии Form.player_id.
+# Состояние общее для /profile и /top, поэтому команда берется из данных состояния.
 @dp.message_handler(state=Form.player_id)
-async def process_player_id_for_profile(message: types.Message, state: FSMContext):
+async def process_player_id(message: types.Message, state: FSMContext):
     """
-    Обрабатывает введенный ID игрока для команды /profile.
+    Обрабатывает введенный ID игрока для команды, которая его запросила (/profile или /top).
     """
     try:
-        player_id = int(message.text)
-        await state.finish() # Завершаем состояние FSM
-        await process_player_profile(message, player_id)
+        player_id = int(message.text or "")
     except ValueError:
-        await message.reply("Неверный формат ID игрока. ID должен быть числом. Попробуйте еще раз.")
+        await outbox.reply(message, "Неверный формат ID игрока. ID должен быть числом. Попробуйте еще раз.")
+        return
+    command = (await state.get_data()).get("command", "profile")
+    await state.finish() # Завершаем состояние FSM
+    if command == "top":
+        await process_player_top_heroes(message, player_id)
+    else:
+        await process_player_profile(message, player_id)
 
 # Вспомогательная функция для обработки и вывода профиля игрока
 async def process_player_profile(message: types.Message, player_id: int):
     """
     Получает и форматирует статистику игрока, затем отправляет её.
     """
-    await message.reply(f"Загружаю статистику для игрока с ID: <code>{player_id}</code>...")
-    
-    stats_data = await get_player_stats(player_id)
-    if "error" in stats_data:
-        await message.reply(stats_data["error"])
-        return
+    prefetcher.record(player_id)
+    await outbox.respond(
+        message, f"Загружаю статистику для игрока с ID: <code>{player_id}</code>...",
+        render_player_profile(player_id),
+    )
 
-    wl_data = await get_player_win_loss(player_id)
-    if "error" in wl_data:
-        await message.reply(wl_data["error"])
-        return
+async def render_player_profile(player_id: int, deadline: float = None) -> str:
+    """
+    Загружает статистику игрока и возвращает готовый текст ответа.
+    deadline - сколько ждать OpenDota (по умолчанию COMMAND_DEADLINE).
+    """
+    # Оба запроса идут одновременно: ждем самый медленный, а не их сумму
+    results = await fetch_all({
+        "stats": get_player_stats(player_id),
+        "wl": get_player_win_loss(player_id),
+    }, deadline)
+    stats_data, wl_data = results["stats"], results["wl"]
+    if is_error(stats_data) and (stats_data.get("status") == 404 or is_error(wl_data)):
+        return stats_data["error"] # Игрок не найден или ничего не загрузилось
 
-    profile = stats_data.get("profile", {})
-    mmr_estimate = stats_data.get("mmr_estimate", {})
+    if is_error(stats_data): # Профиль не загрузился - показываем хотя бы W/L
+        player_name, steam_id, solo_mmr, rank_name = f"ID {player_id}", MISSING, MISSING, MISSING
+    else:
+        profile = stats_data.get("profile", {})
+        mmr_estimate = stats_data.get("mmr_estimate", {})
+        player_name = html.escape(profile.get("personaname") or "Неизвестный игрок") # Ник задает сам игрок
+        steam_id = html.escape(str(profile.get("steamid", "N/A")))
+        solo_mmr = mmr_estimate.get("solo_estimate", "N/A")
+        rank_name = get_rank_tier_name(profile.get("rank_tier"))
 
-    player_name = profile.get("personaname", "Неизвестный игрок")
-    steam_id = profile.get("steamid", "N/A")
-    solo_mmr = mmr_estimate.get("solo_estimate", "N/A")
-    rank_tier = profile.get("rank_tier")
-    
-    wins = wl_data.get("win", 0)
-    losses = wl_data.get("lose", 0)
-    total_matches = wins + losses
-    win_rate = (wins / total_matches * 100) if total_matches > 0 else 0
+    if is_error(wl_data): # W/L не загрузился - показываем профиль без него
+        total_matches, wins, losses, win_rate_text = MISSING, MISSING, MISSING, MISSING
+    else:
+        wins = wl_data.get("win", 0)
+        losses = wl_data.get("lose", 0)
+        total_matches = wins + losses
+        win_rate = (wins / total_matches * 100) if total_matches > 0 else 0
+        win_rate_text = f"{win_rate:.2f}%" # Форматируем до двух знаков после запятой
 
     message_text = (
         f"<b>Статистика игрока: {player_name}</b>\n"
         f"Steam ID: <code>{steam_id}</code>\n"
         f"Примерный Solo MMR: {solo_mmr}\n"
-        f"Ранг: {get_rank_tier_name(rank_tier)}\n"
+        f"Ранг: {rank_name}\n"
         f"Всего матчей: {total_matches}\n"
         f"Побед: {wins}, Поражений: {losses}\n"
-        f"Винрейт: {win_rate:.2f}%" # Форматируем до двух знаков после запятой
+        f"Винрейт: {win_rate_text}"
     )
-    await message.reply(message_text)
+    failed = [data["error"] for data in (stats_data, wl_data) if is_error(data)]
+    if failed:
+        message_text += "\n<i>Часть данных не загрузилась: " + " ".join(failed) + "</i>"
+    return message_text
 
 # --- Обработчик для команды /top (лучшие герои) ---
 @dp.message_handler(commands=['top'])
@@ -242,64 +2042,66 @@ async def cmd_top_heroes(message: types.Message, state: FSMContext):
     """
     Обработчик команды /top. Запрашивает ID игрока или обрабатывает его, если он передан сразу.
     """
-    args = message.get_args()
+    args = message.get_args().split() # ID игрока и необязательный фильтр: 20 (игр) или 30d (дней)
     if args:
         try:
-            player_id = int(args)
-            await process_player_top_heroes(message, player_id)
+            player_id = int(args[0])
         except ValueError:
-            await message.reply("Неверный формат ID игрока. ID должен быть числом.")
+            await outbox.reply(message, "Неверный формат ID игрока. ID должен быть числом.")
+            return
+        match_filter = parse_match_filter(args[1]) if len(args) > 1 else (None, None)
+        if match_filter is None:
+            await outbox.reply(message, "Неверный фильтр. Используйте число игр (например, 20) или дней (например, 30d).")
+            return
+        await process_player_top_heroes(message, player_id, *match_filter)
     else:
-        await message.reply("Пожалуйста, введите ID игрока для получения списка лучших героев.")
+        await outbox.reply(message, "Пожалуйста, введите ID игрока для получения списка лучших героев.")
         await Form.player_id.set() # Используем то же состояние, но для другой команды
+        await state.update_data(command="top")
 
-# Обработчик для получения ID игрока, когда бот находится в состоянии Form.player_id для /top
-@dp.message_handler(state=Form.player_id)
-async def process_player_id_for_top(message: types.Message, state: FSMContext):
+# Вспомогательная функция для обработки и вывода лучших героев
+async def process_player_top_heroes(message: types.Message, player_id: int,
+                                    last_n: int = None, days: int = None):
     """
-    Обрабатывает введенный ID игрока для команды /top.
+    Получает и форматирует статистику по лучшим героям игрока, затем отправляет её.
     """
-    try:
-        player_id = int(message.text)
-        await state.finish()
-        await process_player_top_heroes(message, player_id)
-    except ValueError:
-        await message.reply("Неверный формат ID игрока. ID должен быть числом. Попробуйте еще раз.")
+    prefetcher.record(player_id)
+    await outbox.respond(
+        message, f"Загружаю лучших героев для игрока с ID: <code>{player_id}</code>...",
+        render_player_top_heroes(player_id, last_n, days),
+    )
 
-# Вспомогательная функция для обработки и вывода лучших героев
-async def process_player_top_heroes(message: types.Message, player_id: int):
+async def render_player_top_heroes(player_id: int, last_n: int = None, days: int = None,
+                                   deadline: float = None) -> str:
     """
-    Получает и форматирует статистику по лучшим героям игрока, затем отправляет её.
+    Возвращает текст с топ-5 героев игрока.
+    Статистика считается по локальной истории матчей, last_n и days ее ограничивают.
     """
-    await message.reply(f"Загружаю лучших героев для игрока с ID: <code>{player_id}</code>...")
-    
-    heroes_data = await get_player_heroes(player_id)
-    if "error" in heroes_data:
-        await message.reply(heroes_data["error"])
-        return
-    
+    heroes_data, sync_error = await load_player_hero_stats(player_id, last_n, days, deadline)
+    if heroes_data is None:
+        return sync_error["error"]
+
     if not heroes_data:
-        await message.reply("Не найдено данных по героям для этого игрока.")
-        return
+        return "Не найдено данных по героям для этого игрока."
 
     # Сортируем героев по количеству игр и берем топ-5
     top_heroes = sorted(heroes_data, key=lambda x: x.get('games', 0), reverse=True)[:5]
 
-    message_text = f"<b>Топ-5 героев игрока (по количеству игр):</b>\n"
+    message_text = f"<b>Топ-5 героев игрока (по количеству игр{describe_match_filter(last_n, days)}):</b>\n"
     for hero in top_heroes:
         hero_id = hero.get('hero_id')
         games = hero.get('games', 0)
         wins = hero.get('win', 0)
         losses = games - wins
         win_rate = (wins / games * 100) if games > 0 else 0
-        
-        # Нужно получить имя героя по ID. OpenDota API не дает имя героя в этом запросе.
-        # Для простоты, пока будем выводить ID героя. В реальном проекте нужно было бы
-        # загрузить список всех героев с их ID и именами.
+
+        # Имя героя берем из локального справочника
         message_text += (
-            f"  - Герой ID: {hero_id} (Игр: {games}, Винрейт: {win_rate:.2f}%)\n"
+            f"  - {hero_catalog.name(hero_id)} (Игр: {games}, Винрейт: {win_rate:.2f}%)\n"
         )
-    await message.reply(message_text)
+    if sync_error is not None:
+        message_text += STALE_MATCHES_NOTE
+    return message_text
 
 # --- Обработчик для команды /hero (статистика по конкретному герою) ---
 @dp.message_handler(commands=['hero'])
@@ -311,42 +2113,51 @@ async def cmd_hero_stats(message: types.Message, state: FSMContext):
     if len(args) >= 2: # Если ID и имя героя переданы сразу
         try:
             player_id = int(args[0])
-            hero_name = args[1]
-            await process_player_hero_stats(message, player_id, hero_name)
         except ValueError:
-            await message.reply("Неверный формат ID игрока. ID должен быть числом.")
+            await outbox.reply(message, "Неверный формат ID игрока. ID должен быть числом.")
+            return
+        hero_name, match_filter = args[1], (None, None)
+        name_parts = hero_name.rsplit(maxsplit=1) # Последнее слово может быть фильтром: 20 или 30d
+        if len(name_parts) == 2 and parse_match_filter(name_parts[1]) is not None:
+            hero_name, match_filter = name_parts[0], parse_match_filter(name_parts[1])
+        await process_player_hero_stats(message, player_id, hero_name, *match_filter)
     else: # Если не хватает аргументов, запрашиваем
-        await message.reply("Пожалуйста, введите ID игрока и имя героя (например: /hero 123456789 Pudge).")
+        await outbox.reply(message, "Пожалуйста, введите ID игрока и имя героя (например: /hero 123456789 Pudge).")
         # Можно создать отдельное FSM состояние для этого, но для простоты пока так.
         # Или можно использовать FSM для последовательного запроса ID, потом имени героя.
 
 # Вспомогательная функция для обработки и вывода статистики по герою
-async def process_player_hero_stats(message: types.Message, player_id: int, hero_name: str):
+async def process_player_hero_stats(message: types.Message, player_id: int, hero_name: str,
+                                    last_n: int = None, days: int = None):
     """
     Получает и форматирует статистику игрока по конкретному герою, затем отправляет её.
     """
-    await message.reply(f"Загружаю статистику для игрока <code>{player_id}</code> на герое {hero_name}...")
-    
-    # В OpenDota API нет прямого запроса "статистика игрока на герое по имени".
-    # Нужно сначала получить всех героев игрока, потом найти нужного по имени.
-    # Для этого нужен список всех героев Dota 2 с их ID и именами.
-    # Это сложнее, чем кажется, так как API возвращает hero_id, а не имя.
-    # Для простоты, пока будем искать по hero_id, если пользователь его знает.
-    # Или нужно загрузить полный список героев OpenDota и сопоставлять имена.
-
-    # Пример упрощенной логики:
-    # Предположим, что hero_name - это hero_id для простоты
-    try:
-        target_hero_id = int(hero_name) # Если пользователь ввел ID героя
-    except ValueError:
-        await message.reply("Для команды /hero пока поддерживается только ID героя вместо имени. Например: /hero 123456789 1 (где 1 - ID Антимага).")
+    # В OpenDota API нет запроса "статистика игрока на герое по имени",
+    # поэтому сначала находим ID героя по имени в локальном справочнике
+    target_hero_id, candidates = hero_catalog.find(hero_name)
+    if target_hero_id is None:
+        if candidates:
+            await outbox.reply(message, f"Под «{html.escape(hero_name)}» подходит несколько героев: {', '.join(candidates)}. Уточните имя.")
+        else:
+            await outbox.reply(message, f"Герой «{html.escape(hero_name)}» не найден. Попробуйте полное имя, например: /hero 123456789 Pudge.")
         return
 
-    heroes_data = await get_player_heroes(player_id)
-    if "error" in heroes_data:
-        await message.reply(heroes_data["error"])
-        return
-    
+    prefetcher.record(player_id)
+    await outbox.respond(
+        message, f"Загружаю статистику для игрока <code>{player_id}</code> на герое {hero_catalog.name(target_hero_id)}...",
+        render_player_hero_stats(player_id, target_hero_id, last_n, days),
+    )
+
+async def render_player_hero_stats(player_id: int, target_hero_id: int,
+                                   last_n: int = None, days: int = None, deadline: float = None) -> str:
+    """
+    Возвращает текст со статистикой игрока на герое target_hero_id.
+    Статистика считается по локальной истории матчей, last_n и days ее ограничивают.
+    """
+    heroes_data, sync_error = await load_player_hero_stats(player_id, last_n, days, deadline)
+    if heroes_data is None:
+        return sync_error["error"]
+
     found_hero_stats = None
     for hero in heroes_data:
         if hero.get('hero_id') == target_hero_id:
@@ -354,21 +2165,585 @@ async def process_player_hero_stats(message: types.Message, player_id: int, hero
             break
     
     if not found_hero_stats:
-        await message.reply(f"Игрок <code>{player_id}</code> не играл на герое с ID {target_hero_id} или данные не найдены.")
-        return
+        return f"Игрок <code>{player_id}</code> не играл на герое {hero_catalog.name(target_hero_id)} или данные не найдены."
 
     games = found_hero_stats.get('games', 0)
     wins = found_hero_stats.get('win', 0)
     losses = games - wins
     win_rate = (wins / games * 100) if games > 0 else 0
 
-    # В реальном проекте здесь нужно получить имя героя по ID
-    hero_name_display = f"Герой ID {target_hero_id}" # Заглушка
+    hero_name_display = hero_catalog.name(target_hero_id)
 
     message_text = (
-        f"<b>Статистика игрока <code>{player_id}</code> на {hero_name_display}:</b>\n"
+        f"<b>Статистика игрока <code>{player_id}</code> на {hero_name_display}{describe_match_filter(last_n, days)}:</b>\n"
         f"Игр: {games}\n"
         f"Побед: {wins}, Поражений: {losses}\n"
         f"Винрейт: {win_rate:.2f}%"
     )
-    await message.reply(message_text)    
+    if sync_error is not None:
+        message_text += STALE_MATCHES_NOTE
+    return message_text
+
+# --- Обработчики для списка наблюдения (/watch, /unwatch, /watchlist) ---
+@dp.message_handler(commands=['watch'])
+async def cmd_watch(message: types.Message):
+    """
+    Обработчик команды /watch. Добавляет игрока в список наблюдения чата:
+    его статистика будет обновляться заранее, и ответы по нему придут быстрее.
+    """
+    try:
+        player_id = int(message.get_args())
+    except ValueError:
+        await outbox.reply(message, "Укажите ID игрока числом, например: /watch 70388657")
+        return
+    if not await match_store.add_watch(message.chat.id, player_id, WATCHLIST_LIMIT):
+        await outbox.reply(message, f"В списке наблюдения уже {WATCHLIST_LIMIT} игроков. Уберите кого-нибудь через /unwatch.")
+        return
+    prefetcher.watch(player_id)
+    await outbox.reply(message, f"Игрок <code>{player_id}</code> добавлен в список наблюдения: его статистика будет обновляться заранее.")
+
+@dp.message_handler(commands=['unwatch'])
+async def cmd_unwatch(message: types.Message):
+    """
+    Обработчик команды /unwatch. Убирает игрока из списка наблюдения чата.
+    """
+    try:
+        player_id = int(message.get_args())
+    except ValueError:
+        await outbox.reply(message, "Укажите ID игрока числом, например: /unwatch 70388657")
+        return
+    if await match_store.remove_watch(message.chat.id, player_id):
+        await outbox.reply(message, f"Игрок <code>{player_id}</code> убран из списка наблюдения.")
+    else:
+        await outbox.reply(message, f"Игрока <code>{player_id}</code> нет в списке наблюдения.")
+
+@dp.message_handler(commands=['watchlist'])
+async def cmd_watchlist(message: types.Message):
+    """
+    Обработчик команды /watchlist. Показывает список наблюдения чата.
+    """
+    watched = await match_store.watched(message.chat.id)
+    if not watched:
+        await outbox.reply(message, "Список наблюдения пуст. Добавьте игрока командой /watch [ID игрока].")
+        return
+    await outbox.reply(message, "<b>Список наблюдения:</b>\n" + "\n".join(f"  - <code>{player_id}</code>" for player_id in watched))
+
+# --- Обработчики для сравнения игроков (/compare, /party) ---
+def parse_player_ids(text: str):
+    """
+    Разбирает список ID игроков через пробел или запятую, убирая повторы.
+    Возвращает (список ID, None) или (None, текст ошибки).
+    """
+    player_ids = []
+    for token in re.split(r"[\s,]+", text.strip()):
+        if not token:
+            continue
+        if not token.isdigit():
+            return None, f"Неверный ID игрока: «{html.escape(token)}». ID должен быть числом."
+        if int(token) not in player_ids:
+            player_ids.append(int(token))
+    if len(player_ids) > COMPARE_MAX_PLAYERS:
+        return None, f"Можно сравнить не больше {COMPARE_MAX_PLAYERS} игроков за раз."
+    return player_ids, None
+
+@dp.message_handler(commands=['compare'])
+async def cmd_compare(message: types.Message):
+    """
+    Обработчик команды /compare. Сравнивает нескольких игроков в одной таблице.
+    """
+    player_ids, error = parse_player_ids(message.get_args())
+    if error is not None:
+        await outbox.reply(message, error)
+        return
+    if len(player_ids) < 2:
+        await outbox.reply(message, "Укажите хотя бы два ID игроков, например: /compare 70388657 106869122")
+        return
+    await process_compare(message, player_ids)
+
+@dp.message_handler(commands=['party'])
+async def cmd_party(message: types.Message):
+    """
+    Обработчик команды /party. Без аргументов сравнивает игроков из списка наблюдения чата,
+    с аргументами работает как /compare.
+    """
+    if message.get_args().strip():
+        await cmd_compare(message)
+        return
+    player_ids = (await match_store.watched(message.chat.id))[:COMPARE_MAX_PLAYERS]
+    if not player_ids:
+        await outbox.reply(message, "Список наблюдения пуст. Добавьте игроков командой /watch [ID игрока] или укажите ID: /party 70388657 106869122")
+        return
+    await process_compare(message, player_ids)
+
+async def load_compare_row(player_id: int, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Загружает профиль, W/L и героев одного игрока. Герои считаются по локальной
+    истории матчей, как в /top. semaphore ограничивает, сколько игроков группы
+    загружается одновременно.
+    """
+    async with semaphore:
+        results = await fetch_all({
+            "stats": get_player_stats(player_id),
+            "wl": get_player_win_loss(player_id),
+            "heroes": load_player_hero_stats(player_id),
+        })
+    if not is_error(results["heroes"]): # (список героев или None, ошибка синхронизации)
+        heroes_data, sync_error = results["heroes"]
+        results["heroes"] = sync_error if heroes_data is None else heroes_data
+    return results
+
+async def process_compare(message: types.Message, player_ids: list):
+    """
+    Загружает всех игроков группы и отправляет общую таблицу. Для больших групп
+    таблица заполняется в одном сообщении по мере загрузки, не дожидаясь самого медленного игрока.
+    """
+    for player_id in player_ids:
+        prefetcher.record(player_id)
+    semaphore = asyncio.Semaphore(COMPARE_CONCURRENCY)
+    tasks = {asyncio.ensure_future(load_compare_row(player_id, semaphore)): player_id for player_id in player_ids}
+    rows = {}
+    try:
+        if len(player_ids) < COMPARE_STREAM_FROM:
+            async def produce():
+                await asyncio.wait(tasks)
+                rows.update((player_id, task.result()) for task, player_id in tasks.items())
+                return render_compare_table(player_ids, rows)
+            await outbox.respond(message, f"Загружаю статистику {len(player_ids)} игроков...", produce())
+            return
+
+        sent = await outbox.reply(message, render_compare_table(player_ids, rows))
+        last_edit = time.monotonic()
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            rows.update((tasks[task], task.result()) for task in done)
+            if pending and time.monotonic() - last_edit >= COMPARE_EDIT_INTERVAL:
+                sent = await outbox.edit(sent, render_compare_table(player_ids, rows), message)
+                last_edit = time.monotonic()
+        await outbox.edit(sent, render_compare_table(player_ids, rows), message)
+    finally:
+        for task in tasks: # Если отменили саму команду, не оставляем загрузки висеть
+            task.cancel()
+
+def compare_error_label(data: dict) -> str:
+    """
+    Короткая пометка об ошибке для столбца таблицы.
+    """
+    if data.get("status") == 404:
+        return "не найден"
+    if data.get("status") == 429:
+        return "лимит API"
+    return "нет ответа"
+
+def render_compare_table(player_ids: list, rows: dict) -> str:
+    """
+    Таблица сравнения игроков: ранг, винрейт, число матчей и ошибки загрузки,
+    а под ней - герои, которые входят в топ-5 у нескольких игроков.
+    rows - {player_id: результат load_compare_row} для уже загруженных игроков.
+    """
+    lines = [f"{'Игрок':<16} {'Ранг':<10} {'Винрейт':>7} {'Игр':>6}  Ошибка"]
+    shared = {} # hero_id -> [число игроков, игр, побед]
+    for player_id in player_ids:
+        results = rows.get(player_id)
+        if results is None:
+            lines.append(f"{str(player_id):<16} {MISSING:<10} {MISSING:>7} {MISSING:>6}  загрузка...")
+            continue
+        stats_data, wl_data, heroes_data = results["stats"], results["wl"], results["heroes"]
+        name, rank = str(player_id), MISSING
+        if not is_error(stats_data):
+            profile = stats_data.get("profile", {})
+            name = profile.get("personaname") or name
+            rank = get_rank_tier_name(profile.get("rank_tier"))
+        win_rate_text, games_text = MISSING, MISSING
+        if not is_error(wl_data):
+            wins, losses = wl_data.get("win", 0), wl_data.get("lose", 0)
+            games_text = str(wins + losses)
+            win_rate_text = f"{wins / (wins + losses) * 100:.1f}%" if wins + losses > 0 else MISSING
+        failed = [data for data in (stats_data, wl_data, heroes_data) if is_error(data)]
+        if len(failed) == 3 or (is_error(stats_data) and stats_data.get("status") == 404):
+            note = compare_error_label(failed[0]) # Об игроке ничего не известно
+        else:
+            note = "частично" if failed else ""
+        lines.append(f"{name[:16]:<16} {rank[:10]:<10} {win_rate_text:>7} {games_text:>6}  {note}")
+        if not is_error(heroes_data):
+            for hero in sorted(heroes_data, key=lambda x: x.get('games', 0), reverse=True)[:5]:
+                if hero.get('games', 0) > 0:
+                    totals = shared.setdefault(hero.get('hero_id'), [0, 0, 0])
+                    totals[0] += 1
+                    totals[1] += hero.get('games', 0)
+                    totals[2] += hero.get('win', 0)
+
+    header = "<b>Сравнение игроков</b>"
+    if len(rows) < len(player_ids):
+        header += f" (загружено {len(rows)} из {len(player_ids)})"
+    table = html.escape("\n".join(lines))
+    message_text = f"{header}\n<pre>{table}</pre>"
+
+    common = sorted(((totals, hero_id) for hero_id, totals in shared.items() if totals[0] > 1), reverse=True)[:5]
+    if common:
+        message_text += "\n<b>Общие герои из топ-5:</b>\n"
+        for (players, games, wins), hero_id in common:
+            message_text += f"  - {hero_catalog.name(hero_id)} (Игроков: {players}, Игр: {games}, Винрейт: {wins / games * 100:.2f}%)\n"
+    return message_text
+
+# --- Inline-режим: @бот [ID игрока] [Имя героя] [20 | 30d] ---
+
+class InlineDebouncer:
+    """
+    Telegram присылает новый inline-запрос на каждую нажатую букву. Отвечаем
+    только на тот, после которого пользователь delay секунд ничего не печатал,
+    а обработку его предыдущего запроса отменяем - так недопечатанные ID
+    не превращаются в запросы к OpenDota.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._latest = {} # user_id -> задача последнего запроса пользователя
+
+    async def run(self, user_id: int, produce):
+        """
+        Выполняет produce() (корутина-функция) после паузы. Возвращает None,
+        если пользователь успел изменить запрос.
+        """
+        previous = self._latest.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.ensure_future(self._delayed(produce))
+        self._latest[user_id] = task
+        try:
+            await asyncio.wait({task})
+        finally:
+            task.cancel() # Если отменили сам обработчик
+            if self._latest.get(user_id) is task:
+                del self._latest[user_id]
+        if task.cancelled():
+            return None
+        return task.result()
+
+    async def _delayed(self, produce):
+        await asyncio.sleep(self.delay)
+        return await produce()
+
+inline_debouncer = InlineDebouncer(INLINE_DEBOUNCE)
+
+def inline_article(result_id: str, text: str, title: str = None, description: str = None) -> types.InlineQueryResultArticle:
+    """
+    Inline-результат с готовым текстом ответа. Если заголовок и описание
+    не указаны, они берутся из первых строк текста.
+    """
+    lines = [html.unescape(re.sub(r"<[^>]+>", "", line)).strip() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    return types.InlineQueryResultArticle(
+        id=result_id,
+        title=title or lines[0],
+        description=description or ", ".join(lines[1:4]),
+        input_message_content=types.InputTextMessageContent(text),
+    )
+
+def inline_cache_time(texts: list) -> int:
+    """
+    Удачные ответы начинаются с заголовка <b>; ошибки и ответы с пометкой
+    о неполных данных (<i>) Telegram кэширует ненадолго, чтобы повтор шел в OpenDota.
+    """
+    if all(text.startswith("<b>") and "<i>" not in text for text in texts):
+        return INLINE_CACHE_TIME
+    return INLINE_ERROR_CACHE_TIME
+
+def inline_hero_hints(query: str) -> list:
+    """
+    Подсказки имен героев по началу имени - только из локального справочника.
+    """
+    return [
+        inline_article(f"hero:{hero_id}", hero_catalog.name(hero_id),
+                       description=f"Добавьте ID игрока: @бот 70388657 {hero_catalog.name(hero_id)}")
+        for hero_id in hero_catalog.complete(query, limit=10)
+    ]
+
+async def render_inline_results(player_id: int, rest: str) -> list:
+    """
+    Готовит inline-результаты для игрока: профиль и лучших героев, а если
+    указано имя героя - статистику на подходящих героях. Тексты те же, что у команд.
+    """
+    hero_name, match_filter = rest, (None, None)
+    name_parts = rest.rsplit(maxsplit=1) # Последнее слово может быть фильтром: 20 или 30d
+    if name_parts and parse_match_filter(name_parts[-1]) is not None:
+        hero_name, match_filter = " ".join(name_parts[:-1]), parse_match_filter(name_parts[-1])
+
+    if not hero_name:
+        renders = {
+            "profile": render_player_profile(player_id, INLINE_DEADLINE),
+            "top": render_player_top_heroes(player_id, *match_filter, deadline=INLINE_DEADLINE),
+        }
+    else:
+        hero_id, _ = hero_catalog.find(hero_name)
+        hero_ids = [hero_id] if hero_id is not None else hero_catalog.complete(hero_name)
+        if not hero_ids:
+            return []
+        # Все герои считаются по одной синхронизации истории матчей
+        renders = {
+            f"hero:{hero_id}": render_player_hero_stats(player_id, hero_id, *match_filter, deadline=INLINE_DEADLINE)
+            for hero_id in hero_ids
+        }
+
+    prefetcher.record(player_id)
+    # Не успевшие к INLINE_DEADLINE запросы отображаются как недостающие данные, как и в командах
+    texts = await asyncio.gather(*renders.values())
+    suffix = f":{player_id}:{match_filter[0] or ''}:{match_filter[1] or ''}"
+    return [inline_article(name + suffix, text) for name, text in zip(renders, texts)]
+
+@dp.inline_handler()
+async def inline_player_stats(query: types.InlineQuery):
+    """
+    Обработчик inline-запросов: статистика игрока в любом чате через @бот 70388657.
+    """
+    text = query.query.strip()
+    parts = text.split(maxsplit=1)
+    if not parts or not parts[0].isdigit():
+        # Без ID подсказываем героев; OpenDota для этого не нужен
+        results = inline_hero_hints(text) if text else []
+        await answer_inline_query(query, results, INLINE_HINT_CACHE_TIME)
+        return
+
+    async def produce():
+        results = await render_inline_results(int(parts[0]), parts[1] if len(parts) > 1 else "")
+        if not results:
+            return [], INLINE_HINT_CACHE_TIME
+        return results, inline_cache_time([r.input_message_content.message_text for r in results])
+
+    answer = await inline_debouncer.run(query.from_user.id, produce)
+    if answer is None: # Пользователь уже печатает дальше - отвечаем на новый запрос
+        return
+    await answer_inline_query(query, *answer)
+
+async def answer_inline_query(query: types.InlineQuery, results: list, cache_time: int):
+    """
+    Отправляет inline-результаты. Если пусто - предлагает открыть чат с ботом.
+    """
+    try:
+        await outbox.answer_inline(
+            query, results, cache_time,
+            switch_pm_text=None if results else "Введите ID игрока, например: 70388657",
+            switch_pm_parameter=None if results else "inline",
+        )
+    except InvalidQueryID: # Пользователь закрыл ввод или запрос устарел, пока грузили данные
+        logging.info(f"Inline-запрос {query.id} устарел до ответа")
+
+# --- Запуск и остановка бота ---
+
+async def on_startup(dp: Dispatcher):
+    """
+    Выполняется при запуске бота: открываем пул соединений к OpenDota,
+    загружаем справочники и запускаем сервер метрик.
+    """
+    await opendota.start()
+    await match_store.open()
+    await hero_catalog.start()
+    await prefetcher.start()
+    dp["loop_monitor"] = asyncio.ensure_future(monitor_event_loop())
+    metrics_port = dp.get("metrics_port", METRICS_PORT)
+    if metrics_port:
+        dp["metrics_runner"] = await start_metrics_server(metrics_port)
+
+async def on_shutdown(dp: Dispatcher):
+    """
+    Выполняется при остановке бота: закрываем соединения и хранилище FSM.
+    """
+    if dp.get("metrics_runner") is not None:
+        await dp["metrics_runner"].cleanup()
+    if dp.get("loop_monitor") is not None:
+        dp["loop_monitor"].cancel()
+    await prefetcher.close()
+    await hero_catalog.close()
+    await opendota.close()
+    await match_store.close()
+    logging.info(f"Статистика кэша OpenDota: {response_cache.snapshot()}")
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+
+# --- Режим webhook с несколькими процессами ---
+# Главный процесс принимает обновления от Telegram и раскладывает их по процессам-обработчикам
+# по ID чата. Поэтому все сообщения одного чата (и его состояние FSM) всегда попадают
+# в один и тот же процесс, а разные чаты обрабатываются на разных ядрах.
+
+def get_update_chat_id(update: dict) -> int:
+    """
+    ID чата (или пользователя), к которому относится обновление, - по нему выбирается процесс.
+    """
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback is not None:
+        return callback.get("message", {}).get("chat", {}).get("id") or callback["from"]["id"]
+    for key in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer"):
+        if key in update:
+            return update[key].get("from", update[key].get("user", {})).get("id", 0)
+    return update.get("update_id", 0)
+
+def run_webhook_worker(index: int, workers: int, queue):
+    """
+    Точка входа процесса-обработчика: берет обновления из своей очереди и передает их диспетчеру.
+    """
+    # Останавливает обработчики главный процесс (через None в очереди), а не сигналы терминала
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Квота OpenDota общая на весь бот - делим её между процессами
+    opendota.scheduler = RateLimitScheduler(
+        max(1, OPEN_DOTA_RATE_PER_MINUTE // workers), OPEN_DOTA_RATE_PER_DAY // workers,
+        burst=max(1, OPEN_DOTA_BURST // workers), max_queue=OPEN_DOTA_MAX_QUEUE,
+    )
+    # Общий лимит Telegram тоже один на бот (лимиты чатов делить не нужно: чат всегда в одном процессе)
+    prefetcher.index, prefetcher.workers = index, workers
+    global outbox
+    outbox = Outbox(TELEGRAM_GLOBAL_RATE / workers, TELEGRAM_PRIVATE_RATE, TELEGRAM_GROUP_RATE, PLACEHOLDER_DELAY)
+    asyncio.run(_webhook_worker_main(index, queue))
+
+async def _webhook_worker_main(index: int, queue):
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    dp["metrics_port"] = METRICS_PORT + 1 + index if METRICS_PORT else 0 # У каждого процесса свой порт метрик
+    await on_startup(dp)
+    loop = asyncio.get_running_loop()
+    pending = set()
+    logging.info(f"Обработчик {index} запущен (pid {os.getpid()})")
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None: # Сигнал остановки: дальше обновлений не будет
+            break
+        task = asyncio.ensure_future(dp.process_update(types.Update(**data)))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending: # Дорабатываем уже полученные обновления, чтобы не потерять ответы
+        await asyncio.wait(pending, timeout=WEBHOOK_DRAIN_TIMEOUT)
+    await on_shutdown(dp)
+    session = await bot.get_session()
+    await session.close()
+    logging.info(f"Обработчик {index} остановлен")
+
+WEBHOOK_QUEUE = metrics.gauge("webhook_queue_depth", "Обновления в очереди процесса-обработчика", ("worker",))
+
+class WebhookRouter:
+    """
+    Главный процесс в режиме webhook: HTTP-сервер, процессы-обработчики и их очереди.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = []
+        self._processes = []
+        self._draining = False
+        self._supervisor = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_webhook_worker, args=(index, self.workers, self._queues[index]),
+            name=f"webhook-worker-{index}", daemon=True,
+        )
+        process.start()
+        return process
+
+    async def on_startup(self, app: web.Application):
+        self._queues = [self._context.Queue(self.queue_size) for _ in range(self.workers)]
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        self._supervisor = asyncio.ensure_future(self._supervise())
+        if WEBHOOK_HOST:
+            await bot.set_webhook(f"{WEBHOOK_HOST.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET or None)
+
+    async def _supervise(self):
+        """
+        Перезапускает упавшие процессы-обработчики. Их очереди при этом сохраняются.
+        """
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive() and not self._draining:
+                    logging.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапускаю")
+                    self._processes[index] = self._spawn(index)
+
+    async def on_shutdown(self, app: web.Application):
+        """
+        Плавная остановка: перестаем принимать обновления и ждем, пока обработчики разберут очереди.
+        Webhook не удаляем - пока бот перезапускается, Telegram придержит новые обновления у себя.
+        """
+        self._draining = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WEBHOOK_DRAIN_TIMEOUT
+        for index, process in enumerate(self._processes):
+            if not process.is_alive(): # Упавший обработчик очередь уже не разберет, а перезапускать его поздно
+                logging.warning(f"Обработчик {process.name} не работает, его очередь будет потеряна")
+                continue
+            timeout = max(0.1, deadline - loop.time())
+            try: # put блокируется на полной очереди - поэтому не в цикле событий и с таймаутом
+                await loop.run_in_executor(None, lambda target=self._queues[index]: target.put(None, timeout=timeout))
+            except queue.Full:
+                logging.warning(f"Очередь обработчика {process.name} не освободилась, завершаю его принудительно")
+                process.terminate()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logging.warning(f"Обработчик {process.name} не успел остановиться, завершаю принудительно")
+                process.terminate()
+        session = await bot.get_session()
+        await session.close()
+
+    async def handle_update(self, request: web.Request):
+        """
+        Принимает обновление от Telegram и кладет его в очередь нужного обработчика.
+        Если бот останавливается или очередь переполнена, отвечаем 503 - Telegram повторит позже.
+        """
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if self._draining:
+            return web.Response(status=503)
+        update = await request.json()
+        index = get_update_chat_id(update) % self.workers
+        try:
+            self._queues[index].put_nowait(update)
+        except queue.Full:
+            logging.warning(f"Очередь обработчика {index} переполнена")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request):
+        """
+        Состояние бота для балансировщика и мониторинга.
+        """
+        workers = []
+        for index, process in enumerate(self._processes):
+            try:
+                queued = self._queues[index].qsize()
+            except NotImplementedError: # qsize недоступен на macOS
+                queued = None
+            workers.append({"index": index, "alive": process.is_alive(), "queued": queued})
+        healthy = not self._draining and all(worker["alive"] for worker in workers)
+        return web.json_response(
+            {"status": "ok" if healthy else ("draining" if self._draining else "degraded"), "workers": workers},
+            status=200 if healthy else 503,
+        )
+
+    def collect_metrics(self):
+        for index, queue in enumerate(self._queues):
+            try:
+                WEBHOOK_QUEUE.set(queue.qsize(), worker=str(index))
+            except NotImplementedError:
+                pass
+
+    def create_app(self) -> web.Application:
+        metrics.on_collect.append(self.collect_metrics)
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", handle_metrics)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+if __name__ == '__main__':
+    if BOT_MODE == 'webhook':
+        web.run_app(WebhookRouter(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE).create_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)